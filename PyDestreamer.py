@@ -8,94 +8,1082 @@ Unofficial Python port of https://github.com/snobu/destreamer
 Available under MIT license.
 """
 
+import time
+importStart = time.perf_counter() # first, so the imports below can be timed for --profile
+
 import argparse
 import asyncio
-import html
+import hashlib
+import hmac
+import importlib
+import io
+import itertools
 import json
-import keyring
-import m3u8
-import nest_asyncio
 import os
-import pyppeteer 
+import random
 import re
-import requests_async
+import secrets
 import shutil
 import signal
 import subprocess
 import sys
-import time
-import urllib
+import urllib.parse
 
 from datetime import datetime
 from termcolor import colored
-from prompt_toolkit.shortcuts import PromptSession
-from prompt_toolkit.validation import Validator, ValidationError
 
-nest_asyncio.apply()
+# heavy dependencies (pyppeteer, keyring, prompt_toolkit, m3u8, requests_async,
+# cryptography, ...) are imported by lazyImport only on the code paths which need them
+
 argv = None
+browser = None
+metrics = None
+tools = dict() # executable name -> (absolute path or None, version)
+startupProfile = [('module imports', time.perf_counter() - importStart)] # (phase, seconds) for --profile
 
-class NumberValidator(Validator):
-    def __init__(self, maximum):
-        self.maximum = maximum
-        
-    def validate(self, document):
-        text = document.text
 
-        if text:
-            if not text.isdigit():
-                i = 0
-    
-                # Get index of fist non numeric character.
-                # We want to move the cursor here.
-                for i, c in enumerate(text):
-                    if not c.isdigit():
-                        break
-    
-                raise ValidationError(message='This input contains non-numeric characters', cursor_position=i)
-            else:
-                num = int(text)
-                if num >= self.maximum:
-                    raise ValidationError(message='This number is bigger than maximum (%d)' % self.maximum-1)
-            
+def lazyImport(name):
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        startupProfile.append(('import %s' % name, time.perf_counter() - start))
+    return module
+
+
+def numberValidator(maximum):
+    validation = lazyImport('prompt_toolkit.validation')
+
+    class NumberValidator(validation.Validator):
+        def __init__(self, maximum):
+            self.maximum = maximum
             
-def isUtilityInstalled(utility):
-    for cmdpath in os.environ['PATH'].split(os.pathsep) + [os.getcwd()]:
-        try:
-            if os.path.isdir(cmdpath) and any([utility in fn for fn in os.listdir(cmdpath)]):
-                return True
-        except FileNotFoundError:
-            continue
-    return False
+        def validate(self, document):
+            text = document.text
+
+            if text.strip():
+                # the same parsing as -q, so whatever passes here is accepted by chooseRendition
+                try:
+                    choices = parseQuality(text)
+                except argparse.ArgumentTypeError:
+                    i = len(text)
+        
+                    # Get index of fist character which is not a number or a comma.
+                    # We want to move the cursor here.
+                    for i, c in enumerate(text):
+                        if not (c.isdigit() or c == ','):
+                            break
+        
+                    raise validation.ValidationError(message='Enter numbers separated by commas or all', cursor_position=i)
+                if choices != 'all' and any([choice >= self.maximum for choice in choices]):
+                    raise validation.ValidationError(message='This number is bigger than maximum (%d)' % (self.maximum-1))
+
+    return NumberValidator(maximum)
+
+
+def findTool(name):
+    # the exact executable (with PATHEXT on Windows) in $PATH or the current folder, looked up once
+    if name not in tools:
+        path = shutil.which(name) or shutil.which(name, path=os.getcwd())
+        tools[name] = (os.path.abspath(path) if path is not None else None, None)
+    return tools[name][0]
+
+
+def toolVersion(name):
+    # versions are cached by path, size and modification time of the executable, so a run does not start them
+    path = findTool(name)
+    if path is None:
+        return None
+    if tools[name][1] is None:
+        stat = os.stat(path)
+        key = '%s:%d:%d' % (path, stat.st_size, stat.st_mtime)
+        cachePath = os.path.join(argv.cacheDirectory, 'tools.json') if argv.cacheDirectory else None
+        cached = dict()
+        if cachePath is not None and os.path.exists(cachePath):
+            try:
+                with open(cachePath, 'r') as file:
+                    cached = json.load(file)
+            except Exception:
+                pass
+        version = cached.get(key)
+        if version is None:
+            try:
+                output = subprocess.run([path, '-version' if name == 'ffmpeg' else '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10).stdout.decode('utf-8', 'replace')
+                match = re.search(r'version (\S+)', output)
+                version = match.group(1) if match is not None else 'unknown version'
+            except Exception:
+                version = 'unknown version'
+            if cachePath is not None:
+                cached[key] = version
+                try:
+                    os.makedirs(argv.cacheDirectory, exist_ok=True)
+                    with open(cachePath + '.tmp', 'w') as file:
+                        json.dump(cached, file)
+                    os.replace(cachePath + '.tmp', cachePath)
+                except OSError:
+                    pass
+        tools[name] = (path, version)
+    return tools[name][1]
+
+
+def printProfile():
+    print(colored('\nStartup profile:', 'green'))
+    for phase, seconds in startupProfile:
+        print('  %-40s %8.1f ms' % (phase, seconds * 1000))
 
 
 def sanityChecks():
-    if isUtilityInstalled('aria2c'):
-        print(colored('Aria2c is installed and ready.', 'green'))
-    else:
-        print(colored('You need aria2c in $PATH or this script\'s folder for this to work!', 'red'))
-        exit(1)
+    if argv.streamMerge:
+        if argv.noMerge:
+            print(colored('Streaming merge (--streamMerge) cannot be combined with --noMerge.', 'red'))
+            exit(1)
+        if os.name == 'nt':
+            print(colored('Streaming merge (--streamMerge) is not supported on Windows.', 'red'))
+            exit(1)
+        if argv.downloader == 'aria2c':
+            print(colored('Streaming merge (--streamMerge) works only with the native downloader.', 'red'))
+            exit(1)
+        argv.downloader = 'native'
+
+    if argv.downloader == 'auto':
+        argv.downloader = 'aria2c' if findTool('aria2c') is not None else 'native'
+        print(colored('Using %s downloader.' % argv.downloader, 'green'))
+
+    if argv.downloader == 'aria2c':
+        if findTool('aria2c') is not None:
+            print(colored('Aria2c %s is installed and ready (%s).' % (toolVersion('aria2c'), findTool('aria2c')), 'green'))
+        else:
+            print(colored('You need aria2c in $PATH or this script\'s folder for this to work (or use --downloader native)!', 'red'))
+            exit(1)
         
-    if isUtilityInstalled('ffmpeg'):
-        print(colored('FFmpeg is installed and ready.', 'green'))
+    if argv.noMerge:
+        pass # ffmpeg is not needed
+    elif findTool('ffmpeg') is not None:
+        print(colored('FFmpeg %s is installed and ready (%s).' % (toolVersion('ffmpeg'), findTool('ffmpeg')), 'green'))
     else:
         print(colored('You need FFmpeg in $PATH or this script\'s folder for this to work!', 'red'))
         exit(1)
     
+    if argv.fragmentCache > 0 and not argv.cacheDirectory:
+        print(colored('Fragment cache (--fragmentCache) needs --cacheDirectory, fragments will not be cached.', 'yellow'))
+
     if not os.path.exists(argv.outputDirectory):
         os.makedirs(argv.outputDirectory)
         print('Creating output directory:', argv.outputDirectory)
 
+    if not os.path.exists(argv.scratchDirectory):
+        os.makedirs(argv.scratchDirectory)
+        print('Creating scratch directory:', argv.scratchDirectory)
+
 
 def osFixPath(path):
     path = re.compile(r"[\/]").split(path)
     return os.path.abspath(os.path.join(*path))
 
 
-async def downloadVideo(videoUrls, email, password, outputDirectory):
-    global browser
-    email = await handleEmail(email)
-    
-    # handle password
+class JobError(Exception):
+    pass
+
+
+class SessionError(JobError):
+    pass
+
+
+class VideoJob:
+    ids = itertools.count(1)
+
+    def __init__(self, videoUrl):
+        self.id = next(VideoJob.ids)
+        self.videoUrl = videoUrl
+        self.videoID = videoUrl[videoUrl.index("/video/")+7:][0:36] if "/video/" in videoUrl else None # use the video id (36 character after '/video/') as temp dir name
+        self.tmpDir = os.path.join(argv.scratchDirectory, self.videoID) if self.videoID is not None else None
+        self.status = 'queued'
+        self.error = None
+        self.title = None
+        self.duration = None
+        self.renditions = dict() # 'audio', 'audio2', ..., 'video_720p', ... -> playlist paths and segments
+        self.progress = dict() # rendition -> downloaded fragments and bytes
+        self.timings = dict() # pipeline stage -> seconds
+        self.videoPaths = list() # one video per chosen quality
+
+    def fail(self, errorMsg):
+        self.status = 'failed'
+        self.error = errorMsg
+        print(colored('\nVideo %s failed: %s\n' % (self.videoUrl, errorMsg), 'red'))
+
+    def toDict(self):
+        return {'id': self.id, 'videoUrl': self.videoUrl, 'videoID': self.videoID, 'title': self.title, 'status': self.status, 'error': self.error, 'progress': self.progress, 'timings': self.timings, 'videoPaths': self.videoPaths}
+
+
+class Metrics:
+    """
+    Duration and throughput of every stage of every video: login, cookie
+    extraction, metadata, playlists, protection key, download of every
+    rendition (bytes, fragments, retries, MB/s by CDN host), decryption and
+    merge. Each measurement is appended to --metrics as one JSON line, the
+    totals are kept in --prometheus for the node_exporter textfile collector.
+    """
+    def __init__(self):
+        self.stages = dict() # (stage, status) -> [count, seconds]
+        self.transfers = dict() # (rendition, host) -> [bytes, fragments, retries, seconds, last MB/s]
+        self.jobs = dict() # final status -> count
+
+    def record(self, stage, start, job=None, status='ok', **fields):
+        seconds = time.time() - start
+        entry = self.stages.setdefault((stage, status), [0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        if 'bytes' in fields and 'host' in fields:
+            fields['mbPerSecond'] = round(fields['bytes'] / 1e6 / max(0.001, seconds), 3)
+            transfer = self.transfers.setdefault((fields.get('rendition'), fields['host']), [0, 0, 0, 0, 0])
+            transfer[0] += fields['bytes']
+            transfer[1] += fields.get('fragments', 0)
+            transfer[2] += fields.get('retries') or 0
+            transfer[3] += seconds
+            transfer[4] = fields['mbPerSecond']
+        self.write(dict([('time', round(start, 3)), ('stage', stage), ('status', status), ('seconds', round(seconds, 3))] + self.jobFields(job) + list(fields.items())))
+        return seconds
+
+    def jobDone(self, job):
+        self.jobs[job.status] = self.jobs.get(job.status, 0) + 1
+        fields = [('time', round(time.time(), 3)), ('stage', 'job'), ('status', job.status)] + self.jobFields(job)
+        fields += [('error', job.error), ('timings', dict([(name, round(seconds, 3)) for name, seconds in job.timings.items()])), ('bytes', sum([p['bytes'] for p in job.progress.values()]))]
+        self.write(dict(fields))
+
+    def jobFields(self, job):
+        return [] if job is None else [('jobId', job.id), ('videoID', job.videoID), ('title', job.title)]
+
+    def write(self, entry):
+        if argv.metrics is not None:
+            with open(argv.metrics, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+        if argv.prometheus is not None:
+            self.writeTextfile(argv.prometheus)
+
+    def writeTextfile(self, path):
+        label = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"')
+        lines = ['# HELP pydestreamer_stage_seconds_total Time spent in each stage.', '# TYPE pydestreamer_stage_seconds_total counter']
+        lines += ['pydestreamer_stage_seconds_total{stage="%s",status="%s"} %f' % (stage, status, v[1]) for (stage, status), v in sorted(self.stages.items())]
+        lines += ['# HELP pydestreamer_stage_runs_total Number of runs of each stage.', '# TYPE pydestreamer_stage_runs_total counter']
+        lines += ['pydestreamer_stage_runs_total{stage="%s",status="%s"} %d' % (stage, status, v[0]) for (stage, status), v in sorted(self.stages.items())]
+        for i, (name, kind, description) in enumerate([('download_bytes_total', 'counter', 'Downloaded fragment bytes.'), ('download_fragments_total', 'counter', 'Downloaded fragments.'), ('download_retries_total', 'counter', 'Retried fragment requests.'), ('download_seconds_total', 'counter', 'Time spent downloading.'), ('download_last_mb_per_second', 'gauge', 'Throughput of the last download.')]):
+            lines += ['# HELP pydestreamer_%s %s' % (name, description), '# TYPE pydestreamer_%s %s' % (name, kind)]
+            lines += ['pydestreamer_%s{rendition="%s",host="%s"} %s' % (name, label(rendition), label(host), v[i]) for (rendition, host), v in sorted(self.transfers.items())]
+        lines += ['# HELP pydestreamer_jobs_total Finished videos by status.', '# TYPE pydestreamer_jobs_total counter']
+        lines += ['pydestreamer_jobs_total{status="%s"} %d' % (status, count) for status, count in sorted(self.jobs.items())]
+        lines += ['# HELP pydestreamer_last_update_timestamp_seconds Time of the last measurement.', '# TYPE pydestreamer_last_update_timestamp_seconds gauge', 'pydestreamer_last_update_timestamp_seconds %f' % time.time()]
+        with open(path + '.tmp', 'w') as file: # the collector must never read a half written file
+            file.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+class Pipeline:
+    """
+    Bounded worker pool which processes videos in three overlapping stages:
+    playlists/key resolution -> fragment download -> ffmpeg merge.
+    The queues between stages are bounded, so the resolution stage never runs
+    far ahead of the downloads (and keys/cookies do not go stale in the queue).
+    With --streamMerge the download and merge stages are one: fragments are
+    piped into ffmpeg while they are being downloaded.
+    """
+    def __init__(self, cookie, outputDirectory):
+        self.cookie = cookie
+        self.outputDirectory = outputDirectory
+        self.jobs = list() # for the summary of a batch run, the daemon keeps its own history
+        self.resolveQueue = asyncio.Queue()
+        self.downloadQueue = asyncio.Queue(maxsize=argv.downloadWorkers)
+        self.mergeQueue = asyncio.Queue(maxsize=argv.mergeWorkers)
+        self.workers = list()
+        self.queue = None # JobQueue which records the finished jobs
+        self.keyCache = KeyCache(argv.cacheDirectory)
+        self.fragmentCache = FragmentCache(argv.cacheDirectory, argv.fragmentCache * 1e9)
+        self.bandwidth = BandwidthController()
+        self.connections = ConnectionBudget(argv.conn)
+        self.disk = DiskSpace(argv.scratchDirectory, outputDirectory)
+        self.downloader = NativeDownloader(cookie, self.bandwidth, self.connections) if argv.downloader == 'native' else None
+        self.pool = lazyImport('concurrent.futures').ProcessPoolExecutor(argv.decryptWorkers) if argv.decryptWorkers > 0 and not argv.streamMerge else None
+
+    async def start(self):
+        for i in range(argv.resolveWorkers):
+            self.workers.append(asyncio.ensure_future(self.worker('resolve', self.resolveQueue, self.downloadQueue, lambda job: resolveJob(job, self.cookie, self.keyCache))))
+        for i in range(argv.downloadWorkers):
+            if argv.streamMerge:
+                self.workers.append(asyncio.ensure_future(self.worker('stream', self.downloadQueue, None, lambda job: self.download(job, streamJob(job, self.cookie, self.downloader, self.fragmentCache, self.outputDirectory)))))
+            else:
+                self.workers.append(asyncio.ensure_future(self.worker('download', self.downloadQueue, None if argv.noMerge else self.mergeQueue, lambda job: self.download(job, downloadJob(job, self.cookie, self.downloader, self.bandwidth, self.connections, self.fragmentCache)))))
+        for i in range(argv.mergeWorkers):
+            self.workers.append(asyncio.ensure_future(self.worker('merge', self.mergeQueue, None, lambda job: mergeJob(job, self.outputDirectory, self.pool))))
+
+    async def download(self, job, stage):
+        # a video starts downloading only when there is disk space for it, the bandwidth is shared by the videos which are downloading right now
+        try:
+            await self.disk.admit(job)
+        except BaseException:
+            stage.close() # never started
+            raise
+        if self.queue is not None:
+            self.queue.started(job) # counted as an attempt only when the download really begins
+        self.bandwidth.register(job)
+        try:
+            await stage
+        finally:
+            self.bandwidth.unregister(job)
+
+    async def finish(self, job):
+        # the job left the pipeline, its temporary files are gone (or kept on purpose)
+        await self.disk.release(job)
+        metrics.jobDone(job)
+        if self.queue is not None:
+            self.queue.finished(job)
+        # the playlists (every segment URL, path and IV) are not needed any more, only the status is kept
+        job.renditions = dict()
+        job.videoOptions = None
+        job.audioObjs = None
+
+    def setCookie(self, cookie):
+        # used by the daemon after it logged in again
+        self.cookie = cookie
+        if self.downloader is not None:
+            self.downloader.cookie = cookie
+
+    def submit(self, job, summary=True):
+        if summary:
+            self.jobs.append(job)
+        self.resolveQueue.put_nowait(job)
+
+    async def worker(self, name, inQueue, outQueue, stage):
+        while True:
+            job = await inQueue.get()
+            start = time.time()
+            try:
+                await stage(job)
+                job.timings[name] = time.time() - start
+                if outQueue is not None:
+                    await outQueue.put(job)
+                else:
+                    job.status = 'done'
+                    await self.finish(job)
+            except JobError as e:
+                job.fail(str(e))
+                await self.finish(job)
+            except Exception as e:
+                job.fail('Unexpected error: %s' % repr(e))
+                await self.finish(job)
+            finally:
+                inQueue.task_done()
+
+    async def join(self):
+        # a job leaves a queue only after it was put into the next one, so joining in stage order is enough
+        await self.resolveQueue.join()
+        await self.downloadQueue.join()
+        await self.mergeQueue.join()
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        if self.downloader is not None:
+            await self.downloader.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def printSummary(self, jobs=None):
+        jobs = self.jobs if jobs is None else list(jobs)
+        failed = [job for job in jobs if job.status != 'done']
+        if len(failed) == 0:
+            print(colored('All jobs done!\n', 'green'))
+        else:
+            print(colored('%d of %d jobs done, %d failed:' % (len(jobs) - len(failed), len(jobs), len(failed)), 'yellow'))
+            for job in failed:
+                print(colored('  %s: %s' % (job.videoUrl, job.error), 'red'))
+            print()
+
+
+class JobQueue:
+    """
+    Persistent list of videos to download (--queue), kept in SQLite so that
+    archiving whole channels survives restarts: every video is added once,
+    finished ones are skipped by the next runs and the status, attempts,
+    last error and saved path of every video are kept.
+    """
+    def __init__(self, path):
+        self.db = lazyImport('sqlite3').connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS videos (videoID TEXT PRIMARY KEY, videoUrl TEXT NOT NULL, source TEXT, title TEXT, status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, error TEXT, videoPath TEXT, added REAL, updated REAL)")
+        self.db.commit()
+
+    def add(self, videoUrls, source):
+        # returns the number of videos which were not in the queue yet
+        now = time.time()
+        jobs = [VideoJob(videoUrl) for videoUrl in videoUrls]
+        for job in jobs:
+            if job.videoID is None:
+                print(colored('Not adding %s to the queue, this is not a Microsoft Stream video link.' % job.videoUrl, 'red'))
+        before = self.db.total_changes
+        self.db.executemany('INSERT OR IGNORE INTO videos (videoID, videoUrl, source, added, updated) VALUES (?, ?, ?, ?, ?)', [(job.videoID, job.videoUrl, source, now, now) for job in jobs if job.videoID is not None])
+        self.db.commit()
+        return self.db.total_changes - before
+
+    def pending(self):
+        return [row[0] for row in self.db.execute("SELECT videoUrl FROM videos WHERE status != 'done' ORDER BY added, rowid")]
+
+    def started(self, job):
+        self.db.execute("UPDATE videos SET status = 'downloading', attempts = attempts + 1, title = ?, updated = ? WHERE videoID = ?", (job.title, time.time(), job.videoID))
+        self.db.commit()
+
+    def finished(self, job):
+        self.db.execute('UPDATE videos SET status = ?, error = ?, title = ?, videoPath = ?, updated = ? WHERE videoID = ?', (job.status, job.error, job.title, '\n'.join(job.videoPaths) or None, time.time(), job.videoID))
+        self.db.commit()
+
+    def counts(self):
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM videos GROUP BY status').fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+def collectionApiUrl(collectionUrl):
+    # channel or group link -> API listing of its videos
+    match = re.search(r'/(channel|group)s?/([0-9a-fA-F-]{36})', collectionUrl)
+    if match is None:
+        raise JobError('%s is not a Microsoft Stream channel or group link.' % collectionUrl)
+    return '%s/api/%ss/%s/videos' % (argv.apiBase, match.group(1), match.group(2))
+
+
+async def listVideos(collectionUrl, cookie):
+    # pages through all videos of a channel or a group, oldest first
+    apiUrl = collectionApiUrl(collectionUrl)
+    pageSize = 100
+    videoUrls = list()
+    session = lazyImport('requests_async').Session()
+    try:
+        while True:
+            response = await session.get('%s?$top=%d&$skip=%d&$orderby=publishedDate%%20asc&api-version=1.4-private' % (apiUrl, pageSize, len(videoUrls)), headers={'Cookie': cookie})
+            if response.status_code != 200:
+                raise JobError('Unable to list the videos of %s (HTTP %d).' % (collectionUrl, response.status_code))
+            page = response.json().get('value', [])
+            videoUrls += ['https://web.microsoftstream.com/video/%s' % video['id'] for video in page]
+            if len(page) < pageSize:
+                return videoUrls
+    finally:
+        await session.close()
+
+
+class KeyCache:
+    """
+    AES protection keys by key URI. Keys are fetched directly over HTTP with
+    the session cookie and shared by all renditions and videos; when a cache
+    directory is set they are also kept on disk for the following runs,
+    readable only by the owner and limited to the most recently used ones.
+    """
+    maxKeys = 1000
+
+    def __init__(self, cacheDirectory):
+        self.directory = os.path.join(cacheDirectory, 'keys') if cacheDirectory else None
+        self.keys = dict()
+        self.locks = dict()
+        if self.directory is not None and os.path.isdir(self.directory):
+            os.chmod(self.directory, 0o700) # made by older versions with the default permissions
+
+    def path(self, keyUri):
+        return os.path.join(self.directory, hashlib.sha1(keyUri.encode('utf-8')).hexdigest())
+
+    async def get(self, keyUri, cookie):
+        if keyUri not in self.locks:
+            self.locks[keyUri] = asyncio.Lock()
+        async with self.locks[keyUri]: # the key is fetched only once even when requested by several videos at once
+            if keyUri in self.keys:
+                return self.keys[keyUri]
+
+            if self.directory is not None and os.path.exists(self.path(keyUri)):
+                with open(self.path(keyUri), 'rb') as file:
+                    key = file.read()
+                if len(key) == 16:
+                    print(colored("Reusing cached protection key.", "green"))
+                    os.utime(self.path(keyUri)) # last use, for the eviction
+                    self.keys[keyUri] = key
+                    return key
+
+            try:
+                response = await lazyImport('requests_async').get(keyUri, headers={'Cookie': cookie})
+            except Exception as e:
+                raise JobError('Failed to download the protection key! (%s)' % repr(e))
+            if response.status_code != 200 or len(response.content) != 16: # AES-128 key
+                raise JobError('Failed to download the protection key! (HTTP %d, %d bytes)' % (response.status_code, len(response.content)))
+            key = response.content
+            print(colored("Protection key downloaded.", "green"))
+
+            if self.directory is not None:
+                self.store(keyUri, key)
+            self.keys[keyUri] = key
+            return key
+
+    def store(self, keyUri, key):
+        # other users of a shared machine must not be able to decrypt the videos
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self.path(keyUri)
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(key)
+        os.replace(path + '.tmp', path)
+        names = [name for name in os.listdir(self.directory) if not name.endswith('.tmp')]
+        if len(names) > self.maxKeys:
+            paths = sorted([os.path.join(self.directory, name) for name in names], key=os.path.getmtime)
+            for path in paths[:len(paths) - self.maxKeys]:
+                os.remove(path) # least recently used first
+
+
+class FragmentCache:
+    """
+    Optional store of downloaded (still encrypted) fragments shared by all
+    videos and runs, kept in --cacheDirectory and keyed by video ID, rendition
+    and fragment URI. It is limited to --fragmentCache GB, the least recently
+    used fragments are evicted first. Cached fragments are hard-linked into
+    the temporary directory of a video instead of being downloaded again, so
+    a video can be merged again (another --format, a failed merge) without
+    any transfer.
+    """
+    def __init__(self, cacheDirectory, maxSize):
+        self.directory = os.path.join(cacheDirectory, 'fragments') if cacheDirectory and maxSize > 0 else None
+        self.maxSize = maxSize
+        self.entries = dict() # cache file path -> [size, last use]
+        self.size = 0
+        if self.directory is not None and os.path.isdir(self.directory):
+            for subdir in os.scandir(self.directory):
+                for entry in os.scandir(subdir.path) if subdir.is_dir() else []:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        self.entries[entry.path] = [stat.st_size, stat.st_mtime]
+                        self.size += stat.st_size
+
+    def path(self, videoID, name, url):
+        # the host is left out, the same fragment is served by different CDN edges
+        digest = hashlib.sha1(('%s/%s/%s' % (videoID, name, urllib.parse.urlparse(url).path)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def touch(self, cachePath):
+        now = time.time()
+        self.entries[cachePath][1] = now
+        try:
+            os.utime(cachePath, (now, now)) # the order survives restarts
+        except OSError:
+            pass
+
+    def add(self, cachePath):
+        size = os.path.getsize(cachePath)
+        if cachePath in self.entries:
+            self.size -= self.entries[cachePath][0]
+        self.entries[cachePath] = [size, time.time()]
+        self.size += size
+
+    def link(self, source, target):
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError: # no hard links across file systems (or on this one)
+            shutil.copyfile(source, target + '.tmp')
+            os.replace(target + '.tmp', target)
+
+    def restore(self, job, name, segments, journal):
+        # links cached fragments into place, returns the fragments which still have to be downloaded
+        if self.directory is None:
+            return segments
+        missing = list()
+        restored = 0
+        for url, path in segments:
+            cachePath = self.path(job.videoID, name, url)
+            if cachePath not in self.entries or not os.path.exists(cachePath):
+                missing.append((url, path))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.link(cachePath, path)
+            self.touch(cachePath)
+            journal.done(path, self.entries[cachePath][0])
+            restored += self.entries[cachePath][0]
+        if len(missing) < len(segments):
+            print(colored("Reusing %d cached %s fragments of '%s' (%.1f MB)." % (len(segments) - len(missing), name, job.title, restored / 1e6), 'green'))
+            journal.save()
+        return missing
+
+    def store(self, job, name, segments, journal):
+        if self.directory is None:
+            return
+        for url, path in segments:
+            cachePath = self.path(job.videoID, name, url)
+            if cachePath in self.entries or not journal.isComplete(path):
+                continue
+            os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+            try:
+                self.link(path, cachePath)
+            except OSError:
+                continue
+            self.add(cachePath)
+        self.evict()
+
+    def read(self, job, name, url):
+        # used by the streaming merge, which keeps no fragment files
+        if self.directory is None:
+            return None
+        cachePath = self.path(job.videoID, name, url)
+        if cachePath not in self.entries:
+            return None
+        try:
+            with open(cachePath, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        self.touch(cachePath)
+        return data
+
+    def write(self, job, name, url, data):
+        if self.directory is None:
+            return
+        cachePath = self.path(job.videoID, name, url)
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with open(cachePath + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(cachePath + '.tmp', cachePath)
+        self.add(cachePath)
+        self.evict()
+
+    def evict(self):
+        if self.size <= self.maxSize:
+            return
+        for cachePath, (size, used) in sorted(self.entries.items(), key=lambda entry: entry[1][1]):
+            if self.size <= self.maxSize * 0.9: # some room is freed at once, not on every new fragment
+                break
+            try:
+                os.remove(cachePath) # a hard link in a temporary directory keeps its own copy alive
+            except OSError:
+                pass
+            del self.entries[cachePath]
+            self.size -= size
+
+
+class SegmentJournal:
+    """
+    Per-video record of the state and byte size of every fragment, kept in
+    journal.json of the temporary directory. An interrupted run resumes from
+    it and only the fragments which are missing, failed or no longer of the
+    recorded size are downloaded again. A file without an entry is trusted
+    only when aria2c logged it as complete, anything else may be a fragment
+    which was still being written when the run stopped.
+    """
+    def __init__(self, tmpDir):
+        self.tmpDir = tmpDir
+        self.path = os.path.join(tmpDir, 'journal.json')
+        self.segments = dict()
+        self.lastSave = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as file:
+                    self.segments = json.load(file)
+            except Exception:
+                print(colored('Fragment journal is damaged, downloading the fragments again.', 'yellow'))
+
+    def key(self, path):
+        return os.path.relpath(path, self.tmpDir).replace('\\', '/')
+
+    def done(self, path, size):
+        self.segments[self.key(path)] = {'status': 'done', 'size': size}
+        if time.time() - self.lastSave > 2: # do not rewrite the journal for every fragment
+            self.save()
+
+    def failed(self, path):
+        self.segments[self.key(path)] = {'status': 'failed', 'size': 0}
+
+    def isComplete(self, path):
+        entry = self.segments.get(self.key(path))
+        return entry is not None and entry['status'] == 'done' and os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+    def scan(self, segments, aria2cLog):
+        # aria2c checks every fragment against its Content-Length before it logs it complete
+        completed = set()
+        if os.path.exists(aria2cLog):
+            with open(aria2cLog, 'r', errors='replace') as file:
+                for line in file:
+                    match = re.search(r'Download complete: (.+)$', line.rstrip())
+                    if match:
+                        completed.add(os.path.basename(match.group(1)))
+        for url, path in segments:
+            entry = self.segments.get(self.key(path))
+            if entry is not None and entry['status'] == 'done':
+                if not self.isComplete(path): # changed since it was recorded, e.g. truncated
+                    for stale in (path, path + '.aria2'):
+                        if os.path.exists(stale):
+                            os.remove(stale)
+                    self.failed(path)
+            elif os.path.basename(path) in completed and os.path.exists(path):
+                self.segments[self.key(path)] = {'status': 'done', 'size': os.path.getsize(path)}
+        self.save()
+        if os.path.exists(aria2cLog):
+            os.remove(aria2cLog) # recorded, a file changed later must not be adopted again
+
+    def missing(self, segments):
+        return [(url, path) for url, path in segments if not self.isComplete(path)]
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(self.segments, file, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+        self.lastSave = time.time()
+
+
+class DiskSpace:
+    """
+    Admission control for the scratch (temporary fragments) and output
+    volumes. A video starts downloading only when the space it is estimated
+    to need (declared bandwidth x duration) is free, counting the space still
+    promised to the videos in progress on the same volume; otherwise it waits
+    until enough space is released instead of failing halfway through.
+    """
+    def __init__(self, scratchDirectory, outputDirectory):
+        self.scratch = (os.stat(scratchDirectory).st_dev, scratchDirectory)
+        self.output = (os.stat(outputDirectory).st_dev, outputDirectory)
+        self.reservations = dict() # job id -> (job, bytes of fragments on scratch, bytes of the video on output)
+        self.condition = asyncio.Condition()
+
+    def needs(self, job):
+        if job.duration is None:
+            return None
+        # the declared bandwidth is not exact, audio tracks are downloaded once but saved in every video
+        download = 1.1 * estimateDownload(job)
+        videos = 1.1 * sum([estimateSize(job, playlist) for name, playlist in job.videoObjs])
+        fragments = 0 if argv.streamMerge else download * (2 if argv.decryptWorkers > 0 else 1) # decrypted copies are made next to the fragments
+        return fragments, 0 if argv.noMerge else videos
+
+    def outstanding(self, device):
+        # space promised to the admitted videos which they did not use yet
+        total = 0
+        for job, fragments, video in self.reservations.values():
+            if self.scratch[0] == device:
+                total += max(0, fragments - sum([p['bytes'] for p in job.progress.values()])) # resumed or cached fragments count as used
+            if self.output[0] == device:
+                total += video
+        return total
+
+    def lacking(self, fragments, video):
+        # bytes missing on each volume, the scratch and output directories can be on the same one
+        needs = dict()
+        for (device, directory), size in ((self.scratch, fragments), (self.output, video)):
+            needs[device] = (directory, needs.get(device, (None, 0))[1] + size)
+        return dict([(directory, size - (shutil.disk_usage(directory).free - self.outstanding(device))) for device, (directory, size) in needs.items() if size > 0])
+
+    async def admit(self, job):
+        needs = self.needs(job)
+        if needs is None:
+            print(colored("Unknown duration of '%s', downloading it without checking free disk space." % job.title, 'yellow'))
+            return
+        start = time.time()
+        async with self.condition:
+            while True:
+                lacking = dict([(directory, size) for directory, size in self.lacking(*needs).items() if size > 0])
+                if len(lacking) == 0:
+                    break
+                missing = ', '.join(['%s more in %s' % (formatSize(size), directory) for directory, size in lacking.items()])
+                if len(self.reservations) == 0: # nothing to wait for
+                    raise JobError('Not enough disk space, needs about %s.' % missing)
+                if job.status != 'waiting for disk space':
+                    job.status = 'waiting for disk space'
+                    print(colored("Waiting for disk space for '%s' (needs about %s)..." % (job.title, missing), 'yellow'))
+                try:
+                    await asyncio.wait_for(self.condition.wait(), 30) # space can be freed by others too
+                except asyncio.TimeoutError:
+                    pass
+            self.reservations[job.id] = (job, needs[0], needs[1])
+        if job.status == 'waiting for disk space':
+            metrics.record('diskWait', start, job)
+
+    async def release(self, job):
+        async with self.condition:
+            if self.reservations.pop(job.id, None) is not None:
+                self.condition.notify_all()
+
+
+class AdaptiveLimit:
+    """
+    Connection limit of one downloading stream which is tuned while it runs.
+    Throughput is measured over --tuneInterval windows and the limit climbs
+    in the direction which made it faster; failed requests (throttling,
+    timeouts) halve it.
+    """
+    def __init__(self, limit, adaptive):
+        self.limit = limit
+        self.maximum = min(32, 2 * limit) if adaptive else limit
+        self.adaptive = adaptive
+        self.active = 0
+        self.condition = asyncio.Condition()
+        self.direction = 1
+        self.lastRate = 0
+        self.windowStart = time.time()
+        self.windowBytes = 0
+        self.windowErrors = 0
+        self.failures = 0 # failed requests of the whole stream, reported as retries
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *args):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def failed(self):
+        self.windowErrors += 1
+        self.failures += 1
+
+    async def record(self, size):
+        self.windowBytes += size
+        now = time.time()
+        if not self.adaptive or now - self.windowStart < argv.tuneInterval:
+            return
+        rate = self.windowBytes / (now - self.windowStart)
+        if self.windowErrors > 0:
+            self.limit = max(1, self.limit // 2) # back off, the server (or the link) does not keep up
+            self.direction = 1
+        else:
+            if rate < self.lastRate * 1.05:
+                self.direction = -self.direction # the last step did not help, go back
+            self.limit = max(1, min(self.maximum, self.limit + self.direction))
+        self.lastRate = rate
+        self.windowStart, self.windowBytes, self.windowErrors = now, 0, 0
+        async with self.condition:
+            self.condition.notify_all()
+
+
+class BandwidthController:
+    """
+    Optional global download rate limit (--rateLimit, --rateSchedule or set
+    at runtime through the daemon API) shared fairly: every downloading video
+    gets an equal part of it, its transfers are delayed once it used more.
+    """
+    def __init__(self):
+        self.rateLimit = None # MB/s set at runtime, overrides the command line
+        self.jobs = dict() # job id -> time when the job is allowed to continue
+
+    def currentRate(self):
+        # bytes per second, 0 means unlimited
+        if self.rateLimit is not None:
+            return self.rateLimit * 1e6
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in argv.rateSchedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end): # may span midnight
+                return rate * 1e6
+        return argv.rateLimit * 1e6
+
+    def share(self):
+        return self.currentRate() / max(1, len(self.jobs))
+
+    def register(self, job):
+        self.jobs[job.id] = time.time()
+
+    def unregister(self, job):
+        self.jobs.pop(job.id, None)
+
+    async def throttle(self, job, size):
+        share = self.share()
+        if share <= 0 or job.id not in self.jobs:
+            return
+        now = time.time()
+        self.jobs[job.id] = max(now, self.jobs[job.id]) + size / share # no credit is saved up while idle
+        if self.jobs[job.id] > now:
+            await asyncio.sleep(self.jobs[job.id] - now)
+
+
+class ConnectionBudget:
+    """
+    --conn is one budget for all videos downloading at the same moment. The
+    native downloader takes one connection for every request, aria2c borrows
+    its connections for the whole run; both wait while all of them are in use.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, wanted):
+        # at least one connection, at most the wanted number or what is free
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.free > 0)
+            n = max(1, min(wanted, self.free))
+            self.free -= n
+            return n
+
+    async def release(self, n):
+        async with self.condition:
+            self.free += n
+            self.condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire(1)
+
+    async def __aexit__(self, *args):
+        await self.release(1)
+
+
+def parseRateSchedule(text):
+    # "08:00-18:00=5,18:00-20:00=20" -> [(480, 1080, 5.0), (1080, 1200, 20.0)], rates in MB/s
+    schedule = list()
+    for part in [part.strip() for part in (text or '').split(',') if part.strip() != '']:
+        match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=([\d.]+)$', part)
+        if match is None:
+            raise argparse.ArgumentTypeError('invalid rate schedule entry: %s' % part)
+        h1, m1, h2, m2, rate = match.groups()
+        schedule.append((int(h1) * 60 + int(m1), int(h2) * 60 + int(m2), float(rate)))
+    return schedule
+
+
+class NativeDownloader:
+    """
+    In-process alternative to aria2c. All segments are fetched through one
+    pooled keep-alive HTTP session with a per-host connection limit, every
+    request has its own timeout and failed requests are retried with
+    exponential backoff. Each segment is written to disk as soon as it
+    arrives (through a .part file, so an interrupted write never looks done)
+    and recorded in the journal of its video.
+    """
+    def __init__(self, cookie, bandwidth, connections):
+        self.cookie = cookie
+        self.bandwidth = bandwidth
+        self.connections = connections
+        self.session = lazyImport('requests_async').Session()
+        self.hostLimits = dict()
+
+    def hostLimit(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self.hostLimits:
+            self.hostLimits[host] = asyncio.Semaphore(argv.hostConn)
+        return self.hostLimits[host]
+
+    async def get(self, url, limit=None):
+        for attempt in range(argv.retries + 1):
+            try:
+                async with self.connections, self.hostLimit(url):
+                    response = await asyncio.wait_for(self.session.get(url, headers={'Cookie': self.cookie}), argv.segmentTimeout)
+                if response.status_code in (401, 403):
+                    raise JobError('HTTP %d for %s' % (response.status_code, url)) # retrying would not help
+                if response.status_code != 200:
+                    raise IOError('HTTP %d' % response.status_code)
+                expected = response.headers.get('Content-Length')
+                if expected is not None and int(expected) != len(response.content):
+                    raise IOError('Short read: %d of %s bytes' % (len(response.content), expected))
+                return response.content
+            except JobError:
+                raise
+            except Exception as e:
+                if limit is not None:
+                    limit.failed()
+                if attempt == argv.retries:
+                    raise IOError('Failed to download %s after %d attempts (%s)' % (url, attempt + 1, repr(e)))
+                await asyncio.sleep(min(30, 0.5 * 2 ** attempt) * (1 + random.random()))
+
+    async def fetch(self, url, path, limit=None):
+        content = await self.get(url, limit)
+        with open(path + '.part', 'wb') as file:
+            file.write(content)
+        os.replace(path + '.part', path)
+        return len(content)
+
+    async def download(self, job, name, segments, n, journal):
+        if len(segments) > 0:
+            os.makedirs(os.path.dirname(segments[0][1]), exist_ok=True)
+        limit = AdaptiveLimit(n, argv.adaptive)
+        start = time.time()
+        progress = {'done': 0, 'bytes': 0, 'reported': 0}
+
+        async def fetchSegment(url, path):
+            async with limit:
+                try:
+                    size = await self.fetch(url, path, limit)
+                except IOError as e:
+                    journal.failed(path)
+                    print(colored(str(e), 'red'))
+                    return
+                await limit.record(size)
+                await self.bandwidth.throttle(job, size)
+            job.progress[name]['connections'] = limit.limit
+            journal.done(path, size)
+            job.progress[name]['done'] += 1
+            job.progress[name]['bytes'] += size
+            progress['done'] += 1
+            progress['bytes'] += size
+            percent = 100 * progress['done'] // len(segments)
+            if percent >= progress['reported'] + 10 or progress['done'] == len(segments):
+                progress['reported'] = percent
+                print("%s of '%s': %d%% (%d/%d fragments, %.1f MB, %.2f MB/s)" % (name.capitalize(), job.title, percent, progress['done'], len(segments), progress['bytes'] / 1e6, progress['bytes'] / 1e6 / max(0.001, time.time() - start)))
+
+        tasks = [asyncio.ensure_future(fetchSegment(url, path)) for url, path in segments]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            journal.save()
+        return limit.failures
+
+    async def stream(self, job, name, segments, ivs, key, n, writer, fragmentCache):
+        # segments are fetched up to --streamWindow ahead, decrypted and written to the writer strictly in playlist order
+        limit = AdaptiveLimit(n, argv.adaptive)
+        pending = asyncio.Queue(maxsize=argv.streamWindow) # the reorder buffer, holds the fetches in playlist order
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        written = 0
+
+        async def fetchSegment(i, url):
+            data = fragmentCache.read(job, name, url)
+            if data is None:
+                async with limit:
+                    data = await self.get(url, limit)
+                    await limit.record(len(data))
+                    await self.bandwidth.throttle(job, len(data))
+                fragmentCache.write(job, name, url, data)
+            return await loop.run_in_executor(None, decryptSegment, data, key, ivs[i])
+
+        async def schedule():
+            for i, (url, path) in enumerate(segments):
+                await pending.put(asyncio.ensure_future(fetchSegment(i, url)))
+
+        scheduler = asyncio.ensure_future(schedule())
+        try:
+            for i in range(len(segments)):
+                data = await (await pending.get())
+                writer.write(data)
+                await writer.drain()
+                written += len(data)
+                job.progress[name] = {'fragments': len(segments), 'done': i + 1, 'bytes': written, 'connections': limit.limit}
+                if (i + 1) % max(1, len(segments) // 10) == 0 or i + 1 == len(segments):
+                    print("%s of '%s': %d%% streamed (%d/%d fragments, %.1f MB, %.2f MB/s)" % (name.capitalize(), job.title, 100 * (i + 1) // len(segments), i + 1, len(segments), written / 1e6, written / 1e6 / max(0.001, time.time() - start)))
+        except (BrokenPipeError, ConnectionResetError):
+            raise JobError('ffmpeg stopped reading the %s stream.' % name)
+        except IOError as e:
+            raise JobError(str(e))
+        finally:
+            done = job.progress.get(name, {}).get('done', 0)
+            metrics.record('stream', start, job, 'ok' if done == len(segments) else 'failed', rendition=name, host=segmentHost(segments), bytes=written, fragments=done, retries=limit.failures)
+            scheduler.cancel()
+            while not pending.empty():
+                pending.get_nowait().cancel()
+            writer.close()
+
+    async def close(self):
+        await self.session.close()
+
+
+aria2c_codes = ['All downloads were successful.','An unknown error occurred.','Time out occurred.','A resource was not found.','Aria2 saw the specified number of "Resource not found" error. See --max-file-not-found option.','A download aborted because download speed was too slow. See --lowest-speed-limit option.','Network problem occurred.','There were unfinished downloads. This error is only reported if all finished downloads were successful and there were unfinished downloads in a queue when aria2 exited by pressing ctrl-c by an user or sending term or int signal.','Remote server did not support resume when resume was required to complete download.','There was not enough disk space available.','Piece length was different from one in .Aria2 control file. See --allow-piece-length-change option.','Aria2 was downloading same file at that moment.','Aria2 was downloading same info hash torrent at that moment.','File already existed. See --allow-overwrite option.','Renaming file failed. See --auto-file-renaming option.','Aria2 could not open existing file.','Aria2 could not create new file or truncate existing file.','File I/o error occurred.','Aria2 could not create directory.','Name resolution failed.','Aria2 could not parse metalink document.','Ftp command failed.','Http response header was bad or unexpected.','Too many redirects occurred.','Http authorization failed.','Aria2 could not parse bencoded file (usually ".Torrent" file).','".Torrent" file was corrupted or missing information that aria2 needed.','Magnet uri was bad.','Bad/unrecognized option was given or unexpected option argument was given.','The remote server was unable to handle the request due to a temporary overloading or maintenance.','Aria2 could not parse json-rpc request.','Reserved. Not used.','Checksum validation failed.']
+
+
+async def runCommand(cmd):
+    # runs the command without blocking the event loop, so other stages keep working meanwhile
+    if argv.showCmd:
+        print(colored(cmd, 'yellow'))
+    p = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    await p.communicate()
+    return p.returncode
+
+
+async def handlePassword(email, password):
+    keyring = lazyImport('keyring') if argv.noKeyring is False else None
     if password is None: # password not passed as argument
         if argv.noKeyring is False:
             try:
@@ -117,243 +1105,906 @@ async def downloadVideo(videoUrls, email, password, outputDirectory):
                 print("Your password has been saved. Next time, you can avoid entering it!")
             except:
                 pass # X11 is missing. Can't use keytar
-     
-    print('\nLaunching headless Chrome to perform the OpenID Connect dance...')
-    browser = await pyppeteer.launch(options={'headless': not argv.noHeadless and not argv.manualLogin, 'args': ['--no-sandbox', '--disable-dev-shm-usage', '--lang=en-US']})
-    
-    page = await browser.newPage()
-    
+    return password
+
+
+async def getBrowser():
+    # the browser is launched only when it is really needed (login)
+    global browser
+    if browser is None:
+        print('\nLaunching headless Chrome...')
+        lazyImport('nest_asyncio').apply()
+        browser = await lazyImport('pyppeteer').launch(options={'headless': not argv.noHeadless and not argv.manualLogin, 'args': ['--no-sandbox', '--disable-dev-shm-usage', '--lang=en-US']})
+    return browser
+
+
+async def closeBrowser():
+    global browser
+    if browser is not None:
+        await browser.close()
+        browser = None
+
+
+async def login(email, password):
+    print('\nPerforming the OpenID Connect dance...')
+    page = await (await getBrowser()).newPage()
+
     print('Navigating to STS login page...')
     await page.goto('https://web.microsoftstream.com/', options={ 'waitUntil': 'networkidle2' })
-    
+
     if not argv.manualLogin:
         if not await defaultLogin(page, email, password):
-            await browser.close()
-            return
+            return None, None
     else:
         await prompt("Login manually inside the browser and then press Enter.")
-    
+
     await page.waitForRequest(lambda req: 'microsoftstream.com/' in req.url and req.method == 'GET')
-    
+
     print('We are logged in. ')
     await asyncio.sleep(5)
-    cookie = await extractCookies(page)
+    start = time.time()
+    cookie, expires = await extractCookies(page)
+    metrics.record('cookies', start, status='ok' if cookie is not None else 'failed')
     if cookie is None:
-        browser.close()
-        return
+        return None, None
     print('Got required authentication cookies.')
-    
-    for videoUrl in videoUrls:
-        print(colored('\nStart downloading video: %s\n' % videoUrl, 'green'))
-        
-        videoID = videoUrl[videoUrl.index("/video/")+7:][0:36] # use the video id (36 character after '/video/') as temp dir name
-        full_tmp_dir = os.path.join(argv.outputDirectory, videoID)
-        
-        await page.goto('https://euwe-1.api.microsoftstream.com/api/videos/%s?api-version=1.0-private' % videoID, options={'headers': {'Cookie': cookie}})
-        response = await page.content()
-        req = html.unescape(response[response.index('{'):response.rindex('}')+1])
-        obj = json.loads(req)
-        
-        if 'error' in obj:
-            if obj["error"]["code"] == 'Forbidden':
-                errorMsg = 'You are not authorized to access this video.\n'
-            else:
-                errorMsg = '\nError downloading this video! %s: %s.\n' % (obj["error"]["code"], obj["error"]["message"])
-            print(colored(errorMsg, 'red'))
-            await browser.close()
-            return
-        
-        #☺ creates tmp dir
-        if not os.path.exists(full_tmp_dir):
-            os.makedirs(full_tmp_dir)
-        else:
-            if argv.overwrite:
-                print("Overwrite enabled - removing old temporary files")
-                shutil.rmtree(full_tmp_dir)
-                os.makedirs(full_tmp_dir)
-        
-        title = obj["name"].strip()
-        print('\nVideo title is:', title)
-        title = re.sub('/[/\\?%*:|"<>]/g', '-', title) # remove illegal characters
-        isoDate = obj["publishedDate"]
-        if isoDate is not None and isoDate != '':
-            date = datetime.strptime(isoDate[:-2], '%Y-%m-%dT%H:%M:%S.%f')
-            
-            uploadDate = '%02d_%02d_%02d' % (date.day, date.month, date.year)
-            title = 'Lesson ' + uploadDate + ' - ' + title
-        else:
-            pass # print("no upload date found")
-        
-        title = re.sub('[^0-9a-zA-Z]+', '_', title)
-   
-        playbackUrls = obj["playbackUrls"]
-        hlsUrl = ''
-        for elem in playbackUrls:
-            if elem['mimeType'] == 'application/vnd.apple.mpegurl':
-                u = urllib.parse.urlparse(elem['playbackUrl'])
-                for qpart in u.query.split("&"):
-                    parts = qpart.split("=", maxsplit=1)
-                    if parts[0] == "playbackurl":
-                        hlsUrl = parts[1]
-                        break
-                break
-        
-        response = await requests_async.get(hlsUrl)
-        parsedManifest = m3u8.loads(response.text).data
-           
-        question = '\n'
-        video_options = list()
-        count = 0
-        i = 0
-        for playlist in parsedManifest["playlists"]:
-            if 'resolution' in playlist['stream_info']:
-                question = question + '[' + str(i) + '] ' + playlist['stream_info']['resolution'] + '\n'
-                count = count + 1
-                video_options.append(playlist)
-            else:
-                # if "RESOLUTION" key doesn't exist, means the current playlist is the audio playlist
-                # fix this for multiple audio tracks
-                audioObj = parsedManifest['playlists'][i]
-            i += 1
-        
-        #  if quality is passed as argument use that, otherwise prompt
-        if argv.quality is None:
-            question = question + 'Choose the desired resolution: '
-            res_choice = int(await prompt(question, validator=NumberValidator(count)))
+    await page.close()
+    return cookie, expires
+
+
+def loadCachedSession(email):
+    # session cookies are kept in the system keyring together with their expiry
+    if argv.noKeyring or argv.noSessionCache:
+        return None
+    try:
+        data = lazyImport('keyring').get_password("PyDestreamer-session", email)
+    except:
+        return None # keyring is not usable on this system
+    if data is None:
+        return None
+    try:
+        session = json.loads(data)
+        if session["expires"] - 60 > time.time():
+            return session["cookie"]
+    except Exception:
+        pass
+    clearCachedSession(email)
+    return None
+
+
+def saveCachedSession(email, cookie, expires):
+    if argv.noKeyring or argv.noSessionCache:
+        return
+    try:
+        lazyImport('keyring').set_password("PyDestreamer-session", email, json.dumps({'cookie': cookie, 'expires': expires}, separators=(',', ':')))
+    except:
+        print(colored('Unable to cache the session in system keyring, next run will need to log in again.', 'yellow'))
+
+
+def clearCachedSession(email):
+    try:
+        lazyImport('keyring').delete_password("PyDestreamer-session", email)
+    except:
+        pass
+
+
+async def sessionIsValid(cookie, videoUrls, collectionUrls=[]):
+    # asks the API for metadata of the first video (or the first video of a channel), only an authentication failure means the session is gone
+    videoIDs = [job.videoID for job in map(VideoJob, videoUrls) if job.videoID is not None]
+    if len(videoIDs) > 0:
+        url = '%s/api/videos/%s?api-version=1.0-private' % (argv.apiBase, videoIDs[0])
+    else:
+        urls = list()
+        for collectionUrl in collectionUrls:
+            try:
+                urls.append(collectionApiUrl(collectionUrl) + '?$top=1&api-version=1.4-private')
+            except JobError:
+                pass # reported when the queue is filled
+        if len(urls) == 0:
+            return True
+        url = urls[0]
+    try:
+        response = await lazyImport('requests_async').get(url, headers={'Cookie': cookie})
+    except Exception as e:
+        print(colored('Unable to verify the cached session (%s), trying to use it anyway.' % repr(e), 'yellow'))
+        return True
+    return response.status_code != 401
+
+
+async def getSession(email, password, videoUrls, collectionUrls=[]):
+    cookie = loadCachedSession(email)
+    if cookie is not None:
+        start = time.time()
+        valid = await sessionIsValid(cookie, videoUrls, collectionUrls)
+        metrics.record('sessionCheck', start, status='ok' if valid else 'rejected')
+        if valid:
+            print(colored('\nReusing cached session, no need to log in.', 'green'))
+            return cookie
+        print(colored('\nCached session was rejected, logging in again.', 'yellow'))
+        clearCachedSession(email)
+
+    password = await handlePassword(email, password)
+    start = time.time()
+    cookie, expires = await login(email, password)
+    metrics.record('login', start, status='ok' if cookie is not None else 'failed')
+    if cookie is not None:
+        saveCachedSession(email, cookie, expires)
+    return cookie
+
+
+async def fillQueue(queue, videoUrls, collectionUrls, cookie):
+    added = queue.add(videoUrls, 'command line')
+    if added > 0:
+        print('Added %d videos from the command line to the queue.' % added)
+    for collectionUrl in collectionUrls:
+        try:
+            found = await listVideos(collectionUrl, cookie)
+        except JobError as e:
+            print(colored(str(e), 'red'))
+            continue
+        print('%s: %d videos, %d new in the queue.' % (collectionUrl, len(found), queue.add(found, collectionUrl)))
+    counts = queue.counts()
+    print(colored('Queue: %d videos, %d done, %d to download.' % (sum(counts.values()), counts.get('done', 0), sum(counts.values()) - counts.get('done', 0)), 'green'))
+    return queue.pending()
+
+
+async def downloadVideo(videoUrls, email, password, outputDirectory):
+    email = await handleEmail(email)
+
+    # without -v the session is checked on a video waiting in the queue or on the listing of a channel
+    queue = JobQueue(argv.queue) if argv.queue is not None else None
+    cookie = await getSession(email, password, (videoUrls or []) + (queue.pending()[:1] if queue is not None else []), argv.channels or [])
+    if cookie is None:
+        await closeBrowser()
+        if queue is not None:
+            queue.close()
+        return
+
+    # the browser is needed only for the login
+    await closeBrowser()
+
+    if queue is not None:
+        videoUrls = await fillQueue(queue, videoUrls or [], argv.channels or [], cookie)
+
+    jobs = [VideoJob(videoUrl) for videoUrl in videoUrls]
+    for job in await resolveMetadata(jobs, cookie):
+        await chooseRendition(job, interactive=queue is None) # nobody is asked about thousands of videos
+
+    pipeline = Pipeline(cookie, outputDirectory)
+    pipeline.queue = queue
+    await pipeline.start()
+    for job in jobs:
+        if job.status == 'resolved':
+            pipeline.submit(job)
         else:
-            argv_quality = int(argv.quality)
-            if argv_quality < 0 or argv.quality > count-1:
-                print(colored('Desired quality is not available for this video (available range: 0-%d)\nI am going to use the best resolution available:' % (count-1), 'yellow'), parsedManifest["playlists"][count-1]['resolution'])
-                res_choice = count-1
+            pipeline.jobs.append(job) # keep failed ones in the summary
+            if queue is not None:
+                queue.finished(job)
+    await pipeline.join()
+
+    await closeBrowser()
+    pipeline.printSummary()
+    if queue is not None:
+        queue.close()
+
+
+class Daemon:
+    """
+    Long-running mode: the session (and the browser used to renew it) stays
+    warm and one pipeline keeps running, videos are submitted to it over a
+    small JSON HTTP API on localhost or on a Unix socket:
+        POST /jobs       {"videoUrls": [...]} -> submitted jobs
+        GET  /jobs       running and last finished jobs with status and progress
+        GET  /jobs/<id>  one job
+        GET  /bandwidth  current rate limit in MB/s (0 = unlimited)
+        PUT  /bandwidth  {"rateLimit": 5} or {"rateLimit": null} for the command line limits
+    Every request needs "Authorization: Bearer <token>" with the token kept in
+    --tokenFile, which only the owner can read, so other users of the machine
+    cannot submit videos under the session or list them.
+    Ctrl-C (or SIGTERM) stops accepting requests and lets the submitted videos
+    finish, pressing it again aborts them.
+    """
+    maxFinished = 1000 # finished jobs remembered for GET /jobs
+
+    def __init__(self, email, password, outputDirectory):
+        self.email = email
+        self.password = password
+        self.outputDirectory = outputDirectory
+        self.cookie = None
+        self.pipeline = None
+        self.jobs = dict()
+        self.sessionLock = asyncio.Lock()
+        self.stopping = asyncio.Event()
+        self.task = None
+        self.token = None
+
+    async def renewSession(self, videoUrls):
+        async with self.sessionLock:
+            cookie = await getSession(self.email, self.password, videoUrls)
+            if cookie is None:
+                raise JobError('Unable to log in.')
+            self.cookie = cookie
+            self.pipeline.setCookie(cookie)
+
+    async def submit(self, videoUrls):
+        jobs = [VideoJob(videoUrl) for videoUrl in videoUrls]
+        for job in jobs:
+            self.jobs[job.id] = job
+        self.forget()
+        resolved = await resolveMetadata(jobs, self.cookie)
+
+        rejected = [job for job in jobs if job.status == 'unauthorized']
+        if len(rejected) > 0:
+            clearCachedSession(self.email)
+            await self.renewSession(videoUrls)
+            for job in rejected:
+                job.status, job.error = 'queued', None
+            resolved += await resolveMetadata(rejected, self.cookie)
+
+        for job in resolved:
+            await chooseRendition(job, interactive=False)
+            self.pipeline.submit(job, summary=False)
+        return jobs
+
+    def forget(self):
+        # the oldest finished jobs are dropped, the ones in progress are always kept
+        finished = [id for id, job in self.jobs.items() if job.status in ('done', 'failed')]
+        for id in finished[:max(0, len(finished) - self.maxFinished)]:
+            del self.jobs[id]
+
+    def loadToken(self):
+        # made once and kept, so the clients can read it from the file between restarts
+        if os.path.exists(argv.tokenFile):
+            os.chmod(argv.tokenFile, 0o600)
+            with open(argv.tokenFile, 'r') as file:
+                token = file.read().strip()
+            if token != '':
+                return token
+        os.makedirs(os.path.dirname(os.path.abspath(argv.tokenFile)), mode=0o700, exist_ok=True)
+        token = secrets.token_urlsafe(32)
+        fd = os.open(argv.tokenFile + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            file.write(token + '\n')
+        os.replace(argv.tokenFile + '.tmp', argv.tokenFile)
+        return token
+
+    def authorized(self, headers):
+        return hmac.compare_digest(headers.get('authorization', '').encode('utf-8'), ('Bearer ' + self.token).encode('utf-8'))
+
+    def bandwidthStatus(self):
+        return {'rateLimit': self.pipeline.bandwidth.currentRate() / 1e6, 'downloading': len(self.pipeline.bandwidth.jobs)}
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, version = (await reader.readline()).decode('latin-1').split()
+            headers = dict()
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if line == '':
+                    break
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            authorized = self.authorized(headers)
+            body = await reader.readexactly(int(headers.get('content-length', 0))) if authorized else b''
+
+            if not authorized:
+                status, result = 401, {'error': 'Missing or wrong token, it is in %s' % argv.tokenFile}
+            elif method == 'POST' and path == '/jobs':
+                videoUrls = json.loads(body.decode('utf-8') or '{}').get('videoUrls') or []
+                if not isinstance(videoUrls, list) or not all([isinstance(videoUrl, str) for videoUrl in videoUrls]):
+                    raise ValueError('videoUrls must be a list of links')
+                jobs = await self.submit(videoUrls)
+                status, result = 200, {'jobs': [job.toDict() for job in jobs]}
+            elif method == 'GET' and path == '/jobs':
+                status, result = 200, {'jobs': [job.toDict() for job in self.jobs.values()]}
+            elif method == 'GET' and path == '/bandwidth':
+                status, result = 200, self.bandwidthStatus()
+            elif method == 'PUT' and path == '/bandwidth':
+                rateLimit = json.loads(body.decode('utf-8') or '{}').get('rateLimit')
+                self.pipeline.bandwidth.rateLimit = None if rateLimit is None else float(rateLimit)
+                status, result = 200, self.bandwidthStatus()
+            elif method == 'GET' and path.startswith('/jobs/') and path[6:].isdigit() and int(path[6:]) in self.jobs:
+                status, result = 200, self.jobs[int(path[6:])].toDict()
             else:
-                res_choice = int(argv.quality)
-                print(colored('Selected resolution:', 'yellow'), video_options[res_choice]['stream_info']['resolution'])
-        
-        videoObj = video_options[res_choice]
-           
-        basePlaylistsUrl = hlsUrl[0:hlsUrl.rindex("/") + 1]
-           
-        # **** VIDEO ****
-        videoLink = basePlaylistsUrl + videoObj['uri']
-           
-        # *** Get protection key (same key for video and audio segments) ***
-        response = (await requests_async.get(videoLink, headers={'Cookie': cookie})).text
-        parsedManifest = m3u8.loads(response).data
-        
-        keyUri = parsedManifest['segments'][0]['key']['uri']
-        cdp = await page.target.createCDPSession()
-        local_key_path = os.path.join(full_tmp_dir, 'protectionKey')
-        await cdp.send('Page.setDownloadBehavior', { 'behavior': 'allow', 'downloadPath': osFixPath(full_tmp_dir)})
+                status, result = 404, {'error': 'Not found'}
+        except Exception as e:
+            status, result = 400, {'error': repr(e)}
+
+        data = json.dumps(result).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (status, {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found'}[status], len(data))).encode('latin-1') + data)
         try:
-            # should download protectionKey file, but throws error: net::ERR_ABORTED
-            await page.goto(keyUri, options={'headers': {'Cookie': cookie}})
-        except pyppeteer.errors.PageError as e:
-            pass
-        
-        await asyncio.sleep(2)
-        if os.path.exists(local_key_path):
-            print(colored("Protection key downloaded.", "green"))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def run(self, listen):
+        self.token = self.loadToken()
+        self.pipeline = Pipeline(None, self.outputDirectory)
+        await self.renewSession([])
+        await self.pipeline.start()
+
+        if listen.startswith('unix:'):
+            server = await asyncio.start_unix_server(self.handle, path=listen[5:])
+            os.chmod(listen[5:], 0o600)
         else:
-            print(colored("Failed to download the protection key!", "red"))
-            await browser.close()
-            return
-        
-        if os.name == 'nt':
-            keyReplacement = local_key_path.replace("\\", "/")
+            host, port = listen.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle, host=host, port=int(port))
+        print(colored('\nDaemon is listening on %s, submit videos with POST /jobs (token in %s).' % (listen, argv.tokenFile), 'green'))
+        self.task = asyncio.current_task()
+        loop = asyncio.get_event_loop()
+        signals = list()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+                signals.append(sig)
+            except (NotImplementedError, RuntimeError):
+                pass # Windows, Ctrl-C ends the daemon at once
+        try:
+            async with server:
+                await self.stopping.wait()
+            print(colored('Not accepting new videos, waiting for the submitted ones to finish (Ctrl-C again to abort)...', 'yellow'))
+            await self.pipeline.join()
+        except asyncio.CancelledError:
+            for task in self.pipeline.workers:
+                task.cancel()
+            await asyncio.gather(*self.pipeline.workers, return_exceptions=True)
+            if self.pipeline.downloader is not None:
+                await self.pipeline.downloader.close()
+            for job in self.jobs.values():
+                if job.status != 'done' and job.error is None:
+                    job.fail('Aborted when the daemon was stopped.')
+            raise
+        finally:
+            for sig in signals:
+                loop.remove_signal_handler(sig)
+            await closeBrowser()
+            self.pipeline.printSummary(self.jobs.values())
+
+    def stop(self):
+        if not self.stopping.is_set():
+            self.stopping.set()
         else:
-            keyReplacement = os.path.abspath(local_key_path)
-        
-        
-        # creates two m3u8 files:
-        # - video_full.m3u8: to download all segements (replacing realtive segements path with absolute remote url)
-        # - video_tmp.m3u8: used by ffmpeg to merge all downloaded segements (in this one we replace the remote key URI with the absoulte local path of the key downloaded above)
-        baseUri = videoLink[0:(videoLink.rindex("/") + 1)]
-        video_full = response.replace('Fragments', baseUri+'Fragments') # local path to full remote url path
-        video_tmp = response.replace(keyUri, keyReplacement) # remote URI to local abasolute path
-        video_tmp = video_tmp.replace('Fragments', os.path.abspath(os.path.join(full_tmp_dir, 'video_segments/Fragments')))
-        video_full_path = os.path.join(full_tmp_dir, 'video_full.m3u8')
-        video_tmp_path = os.path.join(full_tmp_dir, 'video_tmp.m3u8')
-        with open(video_full_path, 'w') as file:
-            file.write(video_full)
-        with open(video_tmp_path, 'w') as file:
-            file.write(video_tmp)
-           
-        n = argv.conn
-        if n > 16:
-            n = 16
-        elif n < 1:
-            n = 1
-        
-        aria2c_codes = ['All downloads were successful.','An unknown error occurred.','Time out occurred.','A resource was not found.','Aria2 saw the specified number of "Resource not found" error. See --max-file-not-found option.','A download aborted because download speed was too slow. See --lowest-speed-limit option.','Network problem occurred.','There were unfinished downloads. This error is only reported if all finished downloads were successful and there were unfinished downloads in a queue when aria2 exited by pressing ctrl-c by an user or sending term or int signal.','Remote server did not support resume when resume was required to complete download.','There was not enough disk space available.','Piece length was different from one in .Aria2 control file. See --allow-piece-length-change option.','Aria2 was downloading same file at that moment.','Aria2 was downloading same info hash torrent at that moment.','File already existed. See --allow-overwrite option.','Renaming file failed. See --auto-file-renaming option.','Aria2 could not open existing file.','Aria2 could not create new file or truncate existing file.','File I/o error occurred.','Aria2 could not create directory.','Name resolution failed.','Aria2 could not parse metalink document.','Ftp command failed.','Http response header was bad or unexpected.','Too many redirects occurred.','Http authorization failed.','Aria2 could not parse bencoded file (usually ".Torrent" file).','".Torrent" file was corrupted or missing information that aria2 needed.','Magnet uri was bad.','Bad/unrecognized option was given or unexpected option argument was given.','The remote server was unable to handle the request due to a temporary overloading or maintenance.','Aria2 could not parse json-rpc request.','Reserved. Not used.','Checksum validation failed.']
+            self.task.cancel()
 
-        print("Downloading video fragments (aria2c)...")
-        aria2cCmd = 'aria2c -i "' + video_full_path + '" -j ' + str(n) + ' -x ' + str(n) + ' -d "' + os.path.join(full_tmp_dir, 'video_segments') + '" --disable-ipv6 --auto-file-renaming=false --allow-overwrite=false --conditional-get=true --header="Cookie:' + cookie + '"';
-        if argv.showCmd:
-            print(colored(aria2cCmd, 'yellow'))
 
-        p = subprocess.Popen(aria2cCmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.communicate()
-        print(colored("Return code: %d (%s)", "green" if p.returncode == 0 else "red") % (p.returncode, aria2c_codes[p.returncode]))
-        
-        # download async. I'm Speed
-        # **** AUDIO ****
-        audioLink = basePlaylistsUrl + audioObj['uri']
-        
-        # same as above but for audio segements
-        response = (await requests_async.get(audioLink, headers={'Cookie': cookie})).text
-        baseUri = audioLink[0:audioLink.rindex("/") + 1]
-        audio_full = response.replace('Fragments', baseUri+'Fragments')
-        audio_tmp = response.replace(keyUri, keyReplacement)
-        audio_tmp = audio_tmp.replace('Fragments', os.path.abspath(os.path.join(full_tmp_dir, 'audio_segments/Fragments')))
-        audio_full_path = os.path.join(full_tmp_dir, 'audio_full.m3u8')
-        audio_tmp_path = os.path.join(full_tmp_dir, 'audio_tmp.m3u8')
-        with open(audio_full_path, 'w') as file:
-            file.write(audio_full)
-        with open(audio_tmp_path, 'w') as file:
-            file.write(audio_tmp)
-           
-        print("Downloading audio fragments (aria2c)...")
-        aria2cCmd = 'aria2c -i "' + audio_full_path + '" -j ' + str(n) + ' -x ' + str(n) + ' -d "' + os.path.join(full_tmp_dir, 'audio_segments') + '" --disable-ipv6 --auto-file-renaming=false --allow-overwrite=false --conditional-get=true --header="Cookie:' + cookie + '"';
-        if argv.showCmd:
-            print(colored(aria2cCmd, 'yellow'))
-
-        p = subprocess.Popen(aria2cCmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.communicate()
-        print(colored("Return code: %d (%s)", "green" if p.returncode == 0 else "red") % (p.returncode, aria2c_codes[p.returncode]))
-           
-
-        # *** MERGE audio and video segements in an video file ***
-        if os.path.exists(os.path.join(outputDirectory, title + '.' + argv.format)):
-            title = title + '-' + str(time.time_ns())
-        
-        videoPath = os.path.abspath(os.path.join(outputDirectory, title + '.' + argv.format))
+async def runDaemon(email, password, outputDirectory, listen):
+    email = await handleEmail(email)
+    try:
+        await Daemon(email, password, outputDirectory).run(listen)
+    except asyncio.CancelledError:
+        print(colored('Daemon aborted, unfinished videos can be resumed later.', 'red'))
 
-        print("Merging fragments into video file (ffmpeg)...")
-        ffmpegCmd = 'ffmpeg -protocol_whitelist file,http,https,tcp,tls,crypto -allowed_extensions ALL -i "' + os.path.abspath(audio_tmp_path) + '" -protocol_whitelist file,http,https,tcp,tls,crypto -allowed_extensions ALL -i "' + os.path.abspath(video_tmp_path) + '" -async 1 -c copy -bsf:a aac_adtstoasc -n "' + videoPath + '"'
-        if argv.showCmd:
-            print(colored(ffmpegCmd, 'yellow'))
 
-        p = subprocess.Popen(ffmpegCmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.communicate()
-        noerr = p.returncode == 0 and os.path.exists(videoPath)
-        print(colored("Return code: %d, file exists: %s", "green" if noerr else "red") % (p.returncode, str(os.path.exists(videoPath))))
+def parseDuration(isoDuration):
+    # ISO 8601 duration as used by the Stream API, e.g. PT1H2M3.5S
+    match = re.match(r'^P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?$', isoDuration or '')
+    if match is None:
+        return None
+    days, hours, minutes, seconds = [float(g) if g else 0 for g in match.groups()]
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
 
-        if noerr:
-            print(colored('Video saved as: \'%s\'\n', 'green') % videoPath)
-            
-            # remove tmp dir
-            if not argv.keepTemp:
-                shutil.rmtree(full_tmp_dir)
-            else:
-                print("Keeping video temporary files as requested.")
+
+def formatSize(size):
+    return '?' if size is None else '%.0f MB' % (size / 1e6)
+
+
+async def fetchMetadata(session, job, cookie):
+    if job.videoID is None:
+        raise JobError('This is not a Microsoft Stream video link.')
+
+    response = await session.get('%s/api/videos/%s?api-version=1.0-private' % (argv.apiBase, job.videoID), headers={'Cookie': cookie})
+    if response.status_code == 401:
+        raise SessionError('The session was rejected by the API.')
+    try:
+        obj = response.json()
+    except ValueError:
+        raise JobError('Unexpected response from the API (HTTP %d).' % response.status_code)
+
+    if 'error' in obj:
+        if obj["error"]["code"] == 'Forbidden':
+            raise JobError('You are not authorized to access this video.')
+        raise JobError('Error downloading this video! %s: %s.' % (obj["error"]["code"], obj["error"]["message"]))
+
+    title = obj["name"].strip()
+    title = re.sub('/[/\\?%*:|"<>]/g', '-', title) # remove illegal characters
+    isoDate = obj["publishedDate"]
+    if isoDate is not None and isoDate != '':
+        date = datetime.strptime(isoDate[:-2], '%Y-%m-%dT%H:%M:%S.%f')
+
+        uploadDate = '%02d_%02d_%02d' % (date.day, date.month, date.year)
+        title = 'Lesson ' + uploadDate + ' - ' + title
+    else:
+        pass # print("no upload date found")
+
+    job.title = re.sub('[^0-9a-zA-Z]+', '_', title)
+    job.duration = parseDuration((obj.get("media") or {}).get("duration"))
+
+    playbackUrls = obj["playbackUrls"]
+    job.hlsUrl = ''
+    for elem in playbackUrls:
+        if elem['mimeType'] == 'application/vnd.apple.mpegurl':
+            u = urllib.parse.urlparse(elem['playbackUrl'])
+            for qpart in u.query.split("&"):
+                parts = qpart.split("=", maxsplit=1)
+                if parts[0] == "playbackurl":
+                    job.hlsUrl = parts[1]
+                    break
+            break
+    if job.hlsUrl == '':
+        raise JobError('No HLS stream available for this video.')
+
+    response = await session.get(job.hlsUrl)
+    parsedManifest = lazyImport('m3u8').loads(response.text).data
+
+    job.videoOptions = list()
+    audioPlaylists = list()
+    for playlist in parsedManifest["playlists"]:
+        if 'resolution' in playlist['stream_info']:
+            job.videoOptions.append(playlist)
         else:
-            print(colored('Failed to process the video with ffmpeg! Keeping temporary files.\n', 'red'))
+            # if "RESOLUTION" key doesn't exist, means the current playlist is an audio playlist
+            audioPlaylists.append(playlist)
+    for media in parsedManifest.get("media", []):
+        # audio tracks can also be declared as renditions of an audio group
+        if media.get('type') == 'AUDIO' and media.get('uri') and media['uri'] not in [playlist['uri'] for playlist in audioPlaylists]:
+            audioPlaylists.append({'uri': media['uri'], 'stream_info': {}})
+    if len(job.videoOptions) == 0 or len(audioPlaylists) == 0:
+        raise JobError('The stream does not contain both video and audio playlists.')
+    job.audioObjs = [('audio' if i == 0 else 'audio%d' % (i + 1), playlist) for i, playlist in enumerate(audioPlaylists)] # every audio track is downloaded
+
+
+def estimateSize(job, playlist):
+    # size estimate from the declared bandwidth of the rendition (and all audio tracks) and the duration of the video
+    if job.duration is None:
+        return None
+    bandwidth = playlist['stream_info'].get('bandwidth', 0) + sum([audio['stream_info'].get('bandwidth', 0) for name, audio in job.audioObjs])
+    return bandwidth / 8 * job.duration
+
+
+def estimateDownload(job):
+    # all chosen qualities, the audio tracks only once
+    return sum([estimateSize(job, playlist) for name, playlist in job.videoObjs]) - (len(job.videoObjs) - 1) * estimateSize(job, {'stream_info': {}})
+
+
+async def resolveMetadata(jobs, cookie):
+    # metadata and master playlists of all videos are fetched up front, a limited number at once
+    print('\nResolving metadata of %d videos...' % len(jobs))
+    limit = asyncio.Semaphore(argv.metadataConn)
+    session = lazyImport('requests_async').Session()
+
+    async def resolve(job):
+        async with limit:
+            start = time.time()
+            try:
+                await fetchMetadata(session, job, cookie)
+                job.status = 'resolved'
+            except SessionError as e:
+                job.fail(str(e))
+                job.status = 'unauthorized' # the daemon logs in again and retries these
+            except JobError as e:
+                job.fail(str(e))
+            except Exception as e:
+                job.fail('Unable to resolve metadata: %s' % repr(e))
+            metrics.record('metadata', start, job, 'ok' if job.status == 'resolved' else job.status)
+
+    try:
+        await asyncio.gather(*[resolve(job) for job in jobs])
+    finally:
+        await session.close()
+
+    for job in jobs:
+        if job.status == 'resolved':
+            options = ', '.join(['%s (~%s)' % (p['stream_info']['resolution'], formatSize(estimateSize(job, p))) for p in job.videoOptions])
+            audio = '' if len(job.audioObjs) == 1 else ', %d audio tracks' % len(job.audioObjs)
+            print('%s: %s [%s]%s' % (job.videoID, job.title, options, audio))
+    return [job for job in jobs if job.status == 'resolved']
+
+
+def parseQuality(text):
+    # "2" -> [2], "0,2" -> [0, 2], "all" -> 'all'
+    text = (text or '').strip().lower()
+    if text == 'all':
+        return text
+    try:
+        choices = [int(part) for part in text.split(',') if part.strip() != '']
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid quality: %s (use e.g. 2, 0,3 or all)' % text)
+    if len(choices) == 0:
+        raise argparse.ArgumentTypeError('invalid quality: %s (use e.g. 2, 0,3 or all)' % text)
+    return choices
+
+
+def videoNames(playlists):
+    # video_720p, video_360p, ... the index is added when two renditions have the same height
+    heights = [playlist['stream_info']['resolution'].split('x')[-1] for playlist in playlists]
+    return ['video_%sp' % height if heights.count(height) == 1 else 'video_%sp_%d' % (height, i) for i, height in enumerate(heights)]
+
+
+async def chooseRendition(job, interactive=True):
+    count = len(job.videoOptions)
+    #  if quality is passed as argument use that, otherwise prompt
+    if argv.quality is None and not interactive:
+        choices = [count-1] # nobody to ask, use the best one
+    elif argv.quality is None:
+        question = '\n'
+        for i, playlist in enumerate(job.videoOptions):
+            question = question + '[' + str(i) + '] ' + playlist['stream_info']['resolution'] + ' (~' + formatSize(estimateSize(job, playlist)) + ')\n'
+        question = question + 'Choose the desired resolution for \'%s\' (several separated by commas or all, nothing for the best): ' % job.title
+        answer = await prompt(question, validator=numberValidator(count))
+        choices = [count-1] if answer is None or answer.strip() == '' else parseQuality(answer) # Ctrl-D or nothing
+    else:
+        choices = argv.quality
+    if choices == 'all':
+        choices = list(range(count))
+    if any([choice < 0 or choice > count-1 for choice in choices]):
+        print(colored('Desired quality is not available for \'%s\' (available range: 0-%d)\nI am going to use the best resolution available instead:' % (job.title, count-1), 'yellow'), job.videoOptions[count-1]['stream_info']['resolution'])
+        choices = [choice if 0 <= choice <= count-1 else count-1 for choice in choices]
+    choices = sorted(set(choices), key=choices.index)
+    names = videoNames(job.videoOptions)
+    job.videoObjs = [(names[choice], job.videoOptions[choice]) for choice in choices]
+
+
+async def resolveJob(job, cookie, keyCache):
+    job.status = 'resolving'
+    print(colored('\nResolving playlists of: %s\n' % job.title, 'green'))
+
+    #☺ creates tmp dir
+    if not os.path.exists(job.tmpDir):
+        os.makedirs(job.tmpDir)
+    else:
+        if argv.overwrite:
+            print("Overwrite enabled - removing old temporary files")
+            shutil.rmtree(job.tmpDir)
+            os.makedirs(job.tmpDir)
+
+    # **** VIDEO and AUDIO playlists (all chosen qualities, all audio tracks) are fetched together ****
+    links = [(name, urllib.parse.urljoin(job.hlsUrl, playlist['uri'])) for name, playlist in job.audioObjs + job.videoObjs]
+    start = time.time()
+    requests_async = lazyImport('requests_async')
+    responses = [r.text for r in await asyncio.gather(*[requests_async.get(link, headers={'Cookie': cookie}) for name, link in links])]
+    metrics.record('playlists', start, job, host=urllib.parse.urlparse(links[0][1]).netloc, length=sum([len(response) for response in responses]))
+
+    local_key_path = os.path.join(job.tmpDir, 'protectionKey')
+    if os.name == 'nt':
+        keyReplacement = local_key_path.replace("\\", "/")
+    else:
+        keyReplacement = os.path.abspath(local_key_path)
+
+    for (name, link), response in zip(links, responses):
+        job.renditions[name] = writePlaylists(job.tmpDir, name, link, response, keyReplacement)
+
+    # *** Get protection key (same key for video and audio segments) ***
+    # only one key is fetched and every key line of the local playlists points at it
+    keyUris = job.renditions[job.videoObjs[0][0]]['keyUris']
+    if len(keyUris) == 0:
+        raise JobError('The video playlist has no protection key.')
+    for name, rendition in job.renditions.items():
+        if len(rendition['keyUris']) > 1:
+            raise JobError('The %s playlist rotates between %d protection keys, which is not supported.' % (name, len(rendition['keyUris'])))
+    keyUri = keyUris[0]
+    if any([rendition['keyUris'] not in ([], [keyUri]) for rendition in job.renditions.values()]):
+        raise JobError('The renditions are protected by different keys, which is not supported.')
+    start = time.time()
+    try:
+        job.key = await keyCache.get(keyUri, cookie)
+    except JobError:
+        metrics.record('key', start, job, 'failed')
+        raise
+    metrics.record('key', start, job)
+    with open(local_key_path, 'wb') as file:
+        file.write(job.key)
+    job.status = 'resolved'
+
+
+def playlistAttributes(text):
+    # 'METHOD=AES-128,URI="https://...",IV=0x...' -> {'METHOD': 'AES-128', 'URI': 'https://...', 'IV': '0x...'}
+    return dict([(name, value[1:-1] if value.startswith('"') else value) for name, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)])
+
+
+def writePlaylists(tmpDir, name, link, response, keyReplacement):
+    # creates two m3u8 files in one pass over the media playlist:
+    # - <name>_full.m3u8: to download all segements (relative segment and key URIs resolved against the playlist URL)
+    # - <name>_tmp.m3u8: used by ffmpeg to merge all downloaded segements (remote key URI replaced with the absoulte local path of the key, segments with their local paths)
+    # only tags and URI lines are looked at, so a title or an attribute containing 'Fragments' is left alone
+    baseUri = link.split('?', 1)[0].rsplit('/', 1)[0] + '/'
+    segmentDir = os.path.abspath(os.path.join(tmpDir, name + '_segments'))
+    full_path = os.path.join(tmpDir, name + '_full.m3u8')
+    tmp_path = os.path.join(tmpDir, name + '_tmp.m3u8')
+    segments = list() # (remote url, local path) pairs, local names are the same as aria2c would use
+    ivs = list() # AES-128 IV of every segment, the media sequence number is used when the playlist does not specify one
+    keyUris = list() # every distinct key URI, in playlist order
+    keys = list() # index in keyUris of the key of every segment (None before the first key)
+    key = None
+    iv = None
+    sequence = 0
+    with open(full_path, 'w') as full, open(tmp_path, 'w') as tmp:
+        for line in io.StringIO(response):
+            line = line.strip()
+            if line == '':
+                continue
+            if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                sequence = int(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-KEY:'):
+                attributes = playlistAttributes(line.split(':', 1)[1])
+                iv = attributes.get('IV')
+                iv = bytes.fromhex(iv[2:] if iv.lower().startswith('0x') else iv) if iv else None
+                if 'URI' in attributes:
+                    uri = urllib.parse.urljoin(link, attributes['URI'])
+                    if uri not in keyUris:
+                        keyUris.append(uri)
+                    key = keyUris.index(uri)
+                    full.write(line.replace('"%s"' % attributes['URI'], '"%s"' % uri) + '\n')
+                    tmp.write(line.replace('"%s"' % attributes['URI'], '"%s"' % keyReplacement) + '\n')
+                    continue
+            elif not line.startswith('#'):
+                if '/' in line or ':' in line.split('?', 1)[0] or line.startswith('.'):
+                    url = urllib.parse.urljoin(link, line)
+                    path = os.path.join(segmentDir, urllib.parse.urlparse(url).path.rsplit('/', 1)[-1])
+                else: # a plain file name next to the playlist, the common case, is much cheaper to resolve
+                    url = baseUri + line
+                    path = os.path.join(segmentDir, line.split('?', 1)[0].split('#', 1)[0])
+                segments.append((url, path))
+                ivs.append(iv if iv is not None else (sequence + len(ivs)).to_bytes(16, 'big'))
+                keys.append(key)
+                full.write(url + '\n')
+                tmp.write(path + '\n')
+                continue
+            full.write(line + '\n')
+            tmp.write(line + '\n')
+    return {'full_path': full_path, 'tmp_path': tmp_path, 'segments': segments, 'ivs': ivs, 'keyUris': keyUris, 'keys': keys}
+
+
+def decryptSegment(data, key, iv):
+    ciphers = lazyImport('cryptography.hazmat.primitives.ciphers')
+    decryptor = ciphers.Cipher(ciphers.algorithms.AES(key), ciphers.modes.CBC(iv), backend=lazyImport('cryptography.hazmat.backends').default_backend()).decryptor()
+    data = decryptor.update(data) + decryptor.finalize()
+    return data[:-data[-1]] if len(data) > 0 else data # PKCS7 padding
+
+
+def decryptSegments(paths, ivs, key, outPath):
+    # runs in a worker process: decrypts a contiguous range of fragments into one clear file
+    with open(outPath, 'wb') as out:
+        for path, iv in zip(paths, ivs):
+            with open(path, 'rb') as file:
+                out.write(decryptSegment(file.read(), key, iv))
+    return outPath
+
+
+async def decryptRendition(job, name, pool):
+    # fragments are split into contiguous ranges, each range is decrypted by another core
+    rendition = job.renditions[name]
+    paths = [path for url, path in rendition['segments']]
+    chunks = max(1, min(len(paths), argv.decryptWorkers * 4)) # a few ranges per worker evens out their sizes
+    bounds = [len(paths) * i // chunks for i in range(chunks + 1)]
+    loop = asyncio.get_event_loop()
+    parts = await asyncio.gather(*[loop.run_in_executor(pool, decryptSegments, paths[a:b], rendition['ivs'][a:b], job.key, os.path.join(job.tmpDir, '%s_clear_%03d.part' % (name, i))) for i, (a, b) in enumerate(zip(bounds, bounds[1:]))])
+    # ffmpeg reads the ranges one after another as a single input
+    return 'concat:' + '|'.join([os.path.abspath(part) for part in parts])
+
+
+def connectionBudget():
+    # the part of --conn one video asks for when all download workers are busy, the remainder is not lost:
+    # ConnectionBudget lends what is free and never more than --conn in total
+    return -(-argv.conn // argv.downloadWorkers)
+
+
+def splitConnections(n, parts):
+    # splits n connections between parts as evenly as possible, each part asks for at least one
+    return [max(1, n // parts + (1 if i < n % parts else 0)) for i in range(parts)]
+
+
+def segmentHost(segments):
+    # the CDN edge serving the fragments, so slow edges can be told apart
+    return urllib.parse.urlparse(segments[0][0]).netloc if len(segments) > 0 else None
+
+
+async def downloadRendition(job, name, segments, n, cookie, downloader, connections, journal, rate):
+    start = time.time()
+    if downloader is not None:
+        print("Downloading %d %s fragments of '%s' (native, %d connections)..." % (len(segments), name, job.title, n))
+        retries = await downloader.download(job, name, segments, n, journal)
+        recordDownload(job, name, segments, journal, start, retries, 'native')
+        return 0
+
+    # fragments which are present but not complete are removed, unless aria2c can resume them
+    for url, path in segments:
+        if os.path.exists(path) and not os.path.exists(path + '.aria2'):
+            os.remove(path)
+    listPath = os.path.join(job.tmpDir, name + '_download.txt')
+    logPath = os.path.join(job.tmpDir, name + '_aria2c.log')
+    with open(listPath, 'w') as file:
+        for url, path in segments:
+            file.write(url + '\n  out=' + os.path.basename(path) + '\n')
+
+    n = await connections.acquire(n) # kept until aria2c exits
+    print("Downloading %d %s fragments of '%s' (aria2c, %d connections)..." % (len(segments), name, job.title, n))
+    aria2cCmd = '"' + findTool('aria2c') + '" -i "' + listPath + '" -j ' + str(n) + ' -x ' + str(n) + ' -d "' + os.path.join(job.tmpDir, name + '_segments') + '" --disable-ipv6 --auto-file-renaming=false --allow-overwrite=false --conditional-get=true --log="' + logPath + '" --log-level=notice --header="Cookie:' + cookie + '"';
+    if rate > 0: # aria2c cannot be tuned while it runs, it gets the share valid when it starts
+        aria2cCmd += ' --max-overall-download-limit=%d' % rate
+    try:
+        returncode = await runCommand(aria2cCmd)
+    finally:
+        await connections.release(n)
+    print(colored("%s of '%s' - return code: %d (%s)", "green" if returncode == 0 else "red") % (name.capitalize(), job.title, returncode, aria2c_codes[returncode]))
+    journal.scan(segments, logPath)
+    recordDownload(job, name, segments, journal, start, None, 'aria2c', returncode=returncode) # aria2c does not report its retries
+    return returncode
+
+
+def recordDownload(job, name, segments, journal, start, retries, downloader, **fields):
+    sizes = [journal.segments[journal.key(path)]['size'] for url, path in segments if journal.isComplete(path)]
+    metrics.record('download', start, job, 'ok' if len(sizes) == len(segments) else 'incomplete', rendition=name, host=segmentHost(segments), downloader=downloader, bytes=sum(sizes), fragments=len(sizes), missing=len(segments) - len(sizes), retries=retries, **fields)
+
+
+def updateProgress(job, journal, names):
+    for name in names:
+        segments = job.renditions[name]['segments']
+        sizes = [journal.segments[journal.key(path)]['size'] for url, path in segments if journal.isComplete(path)]
+        job.progress[name] = {'fragments': len(segments), 'done': len(sizes), 'bytes': sum(sizes)}
+
+
+async def downloadJob(job, cookie, downloader, bandwidth, connections, fragmentCache):
+    job.status = 'downloading'
+    journal = SegmentJournal(job.tmpDir)
+    names = list(job.renditions)
+    for name in names:
+        journal.scan(job.renditions[name]['segments'], os.path.join(job.tmpDir, name + '_aria2c.log')) # fragments changed or finished by an interrupted run
+        start = time.time()
+        missing = journal.missing(job.renditions[name]['segments'])
+        restored = len(missing) - len(fragmentCache.restore(job, name, missing, journal))
+        if restored > 0:
+            metrics.record('fragmentCache', start, job, rendition=name, fragments=restored)
+
+    # the native downloader retries every request itself (--retries, with backoff), only aria2c is run again over what is missing
+    passes = 1 if downloader is not None else argv.retries + 1
+    for attempt in range(passes):
+        updateProgress(job, journal, names)
+        missing = [(name, journal.missing(job.renditions[name]['segments'])) for name in names]
+        missing = [(name, segments) for name, segments in missing if len(segments) > 0]
+        count = sum([len(segments) for name, segments in missing])
+        if count == 0:
+            break
+        if attempt > 0:
+            print(colored("Downloading %d missing fragments of '%s' again (attempt %d)..." % (count, job.title, attempt + 1), 'yellow'))
+
+        # audio and video fragments are downloaded at the same time
+        conns = splitConnections(connectionBudget(), len(missing))
+        await asyncio.gather(*[downloadRendition(job, name, segments, n, cookie, downloader, connections, journal, bandwidth.share() / len(missing)) for (name, segments), n in zip(missing, conns)])
+
+    journal.save()
+    for name in names:
+        fragmentCache.store(job, name, job.renditions[name]['segments'], journal) # also what a failed run got, for the next one
+    updateProgress(job, journal, names)
+    count = sum([len(journal.missing(job.renditions[name]['segments'])) for name in names])
+    if count > 0:
+        raise JobError('%d fragments could not be downloaded, not merging an incomplete video. Run again to resume.' % count)
+    job.status = 'downloaded'
+
+
+def outputPath(job, outputDirectory, suffix=''):
+    title = job.title + suffix
+    if os.path.exists(os.path.join(outputDirectory, title + '.' + argv.format)):
+        title = title + '-' + str(time.time_ns())
+    return os.path.abspath(os.path.join(outputDirectory, title + '.' + argv.format))
+
+
+def removeTemp(job):
+    # remove tmp dir
+    if not argv.keepTemp:
+        shutil.rmtree(job.tmpDir)
+    else:
+        print("Keeping video temporary files as requested.")
+
+
+def ffmpegOutputs(job, outputDirectory):
+    # one video per chosen quality (named with a _<height>p suffix when there are more), each with all audio tracks
+    # ffmpeg reads the inputs in the order: audio tracks, then the videos; all outputs are written by one ffmpeg
+    audioCount = len(job.audioObjs)
+    mapping = len(job.videoObjs) > 1 or audioCount > 1
+    arguments = ''
+    paths = list()
+    for i, (name, playlist) in enumerate(job.videoObjs):
+        videoPath = outputPath(job, outputDirectory, name[5:] if len(job.videoObjs) > 1 else '')
+        if mapping:
+            arguments += ''.join([' -map %d:a' % a for a in range(audioCount)]) + ' -map %d:v' % (audioCount + i)
+        arguments += ' -c copy -bsf:a aac_adtstoasc "' + videoPath + '"'
+        paths.append(videoPath)
+    return ' -async 1 -n' + arguments, paths
+
+
+def finishOutputs(job, returncode, videoPaths, start):
+    noerr = returncode == 0 and all([os.path.exists(videoPath) for videoPath in videoPaths])
+    print(colored("Return code: %d, files exist: %s", "green" if noerr else "red") % (returncode, ', '.join([str(os.path.exists(videoPath)) for videoPath in videoPaths])))
+    metrics.record('merge', start, job, 'ok' if noerr else 'failed', returncode=returncode, size=sum([os.path.getsize(videoPath) for videoPath in videoPaths]) if noerr else 0, videos=len(videoPaths))
+    if not noerr:
+        removeOutputs(videoPaths)
+    return noerr
+
+
+def removeOutputs(videoPaths):
+    for videoPath in videoPaths:
+        if os.path.exists(videoPath):
+            os.remove(videoPath) # never leave a truncated video behind
+
+
+async def mergeJob(job, outputDirectory, pool):
+    job.status = 'merging'
+    # *** MERGE audio and video segements in video files ***
+    names = [name for name, playlist in job.audioObjs + job.videoObjs]
+    outputs, videoPaths = ffmpegOutputs(job, outputDirectory)
+
+    if pool is not None:
+        print("Decrypting fragments of '%s' (%d processes)..." % (job.title, argv.decryptWorkers))
+        start = time.time()
+        inputs = await asyncio.gather(*[decryptRendition(job, name, pool) for name in names])
+        metrics.record('decrypt', start, job, processes=argv.decryptWorkers)
+        print("Merging fragments of '%s' into %d video files (ffmpeg)..." % (job.title, len(videoPaths)))
+        ffmpegCmd = '"' + findTool('ffmpeg') + '"' + ''.join([' -i "' + path + '"' for path in inputs]) + outputs
+    else:
+        print("Merging fragments of '%s' into %d video files (ffmpeg)..." % (job.title, len(videoPaths)))
+        ffmpegCmd = '"' + findTool('ffmpeg') + '"' + ''.join([' -protocol_whitelist file,http,https,tcp,tls,crypto -allowed_extensions ALL -i "' + os.path.abspath(job.renditions[name]['tmp_path']) + '"' for name in names]) + outputs
+    start = time.time()
+    returncode = await runCommand(ffmpegCmd)
+
+    if not finishOutputs(job, returncode, videoPaths, start):
+        raise JobError('Failed to process the video with ffmpeg! Keeping temporary files.')
+
+    job.videoPaths = videoPaths
+    for videoPath in videoPaths:
+        print(colored('Video saved as: \'%s\'', 'green') % videoPath)
+    print()
+    removeTemp(job)
+
+
+async def streamJob(job, cookie, downloader, fragmentCache, outputDirectory):
+    # downloads, decrypts and merges at once: fragments go straight from the network into ffmpeg through pipes
+    job.status = 'streaming'
+    outputs, videoPaths = ffmpegOutputs(job, outputDirectory)
+    loop = asyncio.get_event_loop()
+    names = [name for name, playlist in job.audioObjs + job.videoObjs]
+    pipes = [os.pipe() for name in names]
+
+    ffmpegCmd = '"' + findTool('ffmpeg') + '"' + ''.join([' -i pipe:%d' % r for r, w in pipes]) + outputs
+    if argv.showCmd:
+        print(colored(ffmpegCmd, 'yellow'))
+    print("Streaming fragments of '%s' into %d video files (ffmpeg)..." % (job.title, len(videoPaths)))
+    start = time.time()
+    p = await asyncio.create_subprocess_shell(ffmpegCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=[r for r, w in pipes])
+    for r, w in pipes:
+        os.close(r) # the read ends belong to ffmpeg now
+    output = asyncio.ensure_future(p.communicate()) # ffmpeg stops reading the pipes if nobody reads its progress output
+
+    writers = list()
+    for r, w in pipes:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(w, 'wb'))
+        writers.append(asyncio.StreamWriter(transport, protocol, None, loop))
+
+    conns = splitConnections(connectionBudget(), len(names))
+    tasks = [asyncio.ensure_future(downloader.stream(job, name, job.renditions[name]['segments'], job.renditions[name]['ivs'], job.key, n, writer, fragmentCache)) for name, n, writer in zip(names, conns, writers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel() # the other streams cannot be used without this one
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for writer in writers:
+            writer.close()
+        if p.returncode is None:
+            p.kill()
+        await output
+        removeOutputs(videoPaths)
+        raise
+
+    await output
+    if not finishOutputs(job, p.returncode, videoPaths, start):
+        raise JobError('Failed to process the video with ffmpeg!')
+
+    job.videoPaths = videoPaths
+    for videoPath in videoPaths:
+        print(colored('Video saved as: \'%s\'', 'green') % videoPath)
+    print()
+    removeTemp(job)
 
-        
-        
-    await browser.close()
-    print(colored('All jobs done!\n', 'green'))
-    
 
 async def defaultLogin(page, email, password):
     await page.waitForSelector('input[type="email"]')
@@ -410,7 +2061,7 @@ async def handleEmail(email):
 
 async def prompt(question, validator=None):
     # Create Prompt.
-    session = PromptSession(question)
+    session = lazyImport('prompt_toolkit.shortcuts').PromptSession(question)
 
     # Run echo loop. Read text from stdin, and reply it back.
     while True:
@@ -453,9 +2104,11 @@ async def extractCookies(page):
         
     if authzCookie is None or sigCookie is None:
         print('Unable to read cookies. Try launching one more time, this is not an exact science.')
-        return None
-        
-    return 'Authorization=%s Signature=%s' % (authzCookie["value"], sigCookie["value"])
+        return None, None
+
+    # session cookies (expires = -1) are assumed to live for an hour
+    expires = min([c["expires"] if c.get("expires", -1) > 0 else time.time() + 3600 for c in (authzCookie, sigCookie)])
+    return 'Authorization=%s Signature=%s' % (authzCookie["value"], sigCookie["value"]), expires
 
 async def signal_handler(sig, frame):
     print("Terminating...")
@@ -463,28 +2116,93 @@ async def signal_handler(sig, frame):
         await browser.close()
     exit(1)
 
-if __name__ == "__main__":
-    signal.signal(signal.SIGINT, signal_handler)
-    
+def parseArguments(args):
     parser = argparse.ArgumentParser(prog='PyDestreamer', description='Python port of destreamer.\nProject originally based on https://github.com/snobu/destreamer.\nFork powered by @vrbadev.', epilog='examples:\n\tStandard usage:\n\t\tpython %(prog)s.py -v https://web.microsoftstream.com/video/...\n', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-v', '--videoUrls', type=str, nargs='+', required=True, help='One or more links to Microsoft Stream videos')
+    parser.add_argument('-v', '--videoUrls', type=str, nargs='+', required=False, help='One or more links to Microsoft Stream videos')
     parser.add_argument('-u', '--username', type=str, required=False, help='Your Microsoft Account e-mail')
     parser.add_argument('-p', '--password', type=str, required=False, help='Your Microsoft Account password')
     parser.add_argument('-o', '--outputDirectory', type=str, required=False, default='videos', help='Save directory for videos and temporary files')
-    parser.add_argument('-q', '--quality', type=int, required=False, help='Video Quality, usually [0-5]')
+    parser.add_argument('--scratchDirectory', type=str, required=False, help='Directory for temporary files (fragments) on a separate volume, e.g. tmpfs or local SSD (default: --outputDirectory)')
+    parser.add_argument('-q', '--quality', type=parseQuality, required=False, help='Video Quality, usually [0-5]; several separated by commas (e.g. 0,3) or all, one video is saved per quality')
     parser.add_argument('-k', '--noKeyring', type=bool, required=False, default=False, help='Do not use system keyring (saved password)')
-    parser.add_argument('-c', '--conn', type=int, required=False, default=16, help='Number of simultaneous connections [1-16]')
+    parser.add_argument('-c', '--conn', type=int, required=False, default=16, help='Number of simultaneous connections [1-16], shared by all simultaneous downloads')
     parser.add_argument('-f', '--format', type=str, required=False, default='mp4', help='Output video format, supported by ffmpeg')
+    parser.add_argument('--apiBase', type=str, required=False, default='https://euwe-1.api.microsoftstream.com', help='Base URL of the Microsoft Stream API (region)')
+    parser.add_argument('--cacheDirectory', type=str, required=False, default=os.path.join(os.path.expanduser('~'), '.cache', 'PyDestreamer'), help='Directory for data reused between runs (protection keys), empty string disables it')
+    parser.add_argument('--fragmentCache', type=float, required=False, default=0, help='Keep downloaded fragments in --cacheDirectory up to this size in GB and reuse them instead of downloading again (0 = disabled)')
+    parser.add_argument('--noSessionCache', required=False, default=False, action="store_true", help="Do not reuse the login session cached in system keyring")
     parser.add_argument('--noHeadless', required=False, default=False, action="store_true", help="Don not run Chromium in headless mode")
     parser.add_argument('--manualLogin', required=False, default=False, action="store_true", help="Force login manually")
     parser.add_argument('--overwrite', required=False, default=False, action="store_true", help="Overwrite downloaded temporary files")
     parser.add_argument('--keepTemp', required=False, default=False, action="store_true", help="Do not remove temporary files")
     parser.add_argument('--showCmd', required=False, default=False, action="store_true", help="Show aria2c and ffmpeg commands executed (for debugging)")
+    parser.add_argument('-d', '--downloader', type=str, required=False, default='auto', choices=['auto', 'aria2c', 'native'], help='Fragment downloader: aria2c or in-process native HTTP client (auto = aria2c if installed)')
+    parser.add_argument('--hostConn', type=int, required=False, help='Native downloader: maximum simultaneous connections per host (default: --conn)')
+    parser.add_argument('--retries', type=int, required=False, default=5, help='Number of retries of a failed fragment (native: of every request, aria2c: runs over the missing fragments)')
+    parser.add_argument('--segmentTimeout', type=float, required=False, default=60, help='Native downloader: timeout of a single fragment request in seconds')
+    parser.add_argument('--noMerge', required=False, default=False, action="store_true", help="Only download the fragments and keep them in the temporary directory, do not run ffmpeg")
+    parser.add_argument('--streamMerge', required=False, default=False, action="store_true", help="Decrypt and pipe fragments into ffmpeg while they are downloaded, without temporary fragment files (native downloader)")
+    parser.add_argument('--streamWindow', type=int, required=False, default=64, help='Streaming merge: maximum number of fragments buffered in memory per stream')
+    parser.add_argument('--decryptWorkers', type=int, required=False, default=0, help='Decrypt fragments in this many processes before merging, instead of letting ffmpeg decrypt them in one thread (0 = ffmpeg)')
+    parser.add_argument('--rateLimit', type=float, required=False, default=0, help='Global download rate limit in MB/s shared by all simultaneous downloads (0 = unlimited)')
+    parser.add_argument('--rateSchedule', type=parseRateSchedule, required=False, default=[], help='Rate limits by time of day overriding --rateLimit, e.g. "08:00-18:00=5,18:00-22:00=20" (MB/s)')
+    parser.add_argument('--adaptive', required=False, default=False, action="store_true", help="Native downloader: tune the number of connections of every stream by its measured throughput")
+    parser.add_argument('--tuneInterval', type=float, required=False, default=5, help='Adaptive connections: measurement window in seconds')
+    parser.add_argument('--channels', type=str, nargs='+', required=False, help='Links to Microsoft Stream channels or groups, all their videos are added to the queue')
+    parser.add_argument('--queue', type=str, required=False, help='SQLite file with the videos to download, kept between runs so finished videos are skipped (default with --channels: OUTPUTDIRECTORY/queue.sqlite)')
+    parser.add_argument('--daemon', required=False, default=False, action="store_true", help="Keep running and accept videos over a local HTTP API instead of -v")
+    parser.add_argument('--listen', type=str, required=False, default='127.0.0.1:8765', help='Daemon address, host:port or unix:/path/to/socket')
+    parser.add_argument('--tokenFile', type=str, required=False, help='File with the token required by the daemon API, created readable only by the owner (default: CACHEDIRECTORY/daemon.token)')
+    parser.add_argument('--metadataConn', type=int, required=False, default=8, help='Number of simultaneous metadata requests when resolving all videos up front')
+    parser.add_argument('--resolveWorkers', type=int, required=False, default=2, help='Number of videos resolved (playlists, key) simultaneously')
+    parser.add_argument('--downloadWorkers', type=int, required=False, default=1, help='Number of videos downloaded simultaneously')
+    parser.add_argument('--mergeWorkers', type=int, required=False, default=1, help='Number of videos merged by ffmpeg simultaneously')
+    parser.add_argument('--metrics', type=str, required=False, help='Append duration and throughput of every stage to this file as JSON lines')
+    parser.add_argument('--prometheus', type=str, required=False, help='Keep totals of all stages in this file in Prometheus textfile collector format')
+    parser.add_argument('--profile', required=False, default=False, action="store_true", help="Print how long the imports and the startup phases took")
+
+    argv = parser.parse_args(args)
+    if argv.videoUrls is None and argv.channels is None and argv.queue is None and not argv.daemon:
+        parser.error('the following arguments are required: -v/--videoUrls (or --channels, --queue, --daemon)')
+    if argv.channels is not None and argv.queue is None:
+        argv.queue = os.path.join(argv.outputDirectory, 'queue.sqlite')
+    argv.metadataConn = max(1, argv.metadataConn)
+    argv.resolveWorkers = max(1, argv.resolveWorkers)
+    argv.downloadWorkers = max(1, argv.downloadWorkers)
+    argv.mergeWorkers = max(1, argv.mergeWorkers)
+    argv.conn = max(1, min(16, argv.conn))
+    argv.hostConn = max(1, argv.conn if argv.hostConn is None else argv.hostConn)
+    argv.retries = max(0, argv.retries)
+    argv.streamWindow = max(1, argv.streamWindow)
+    argv.decryptWorkers = max(0, argv.decryptWorkers)
+    argv.fragmentCache = max(0, argv.fragmentCache)
+    if argv.scratchDirectory is None:
+        argv.scratchDirectory = argv.outputDirectory
+    if argv.tokenFile is None:
+        argv.tokenFile = os.path.join(argv.cacheDirectory or argv.outputDirectory, 'daemon.token')
+    return argv
 
-    argv = parser.parse_args(["-h"] if len(sys.argv) == 1 else sys.argv[1:])
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, signal_handler)
     
+    start = time.perf_counter()
+    argv = parseArguments(["-h"] if len(sys.argv) == 1 else sys.argv[1:])
+    metrics = Metrics()
+    startupProfile.append(('argument parsing', time.perf_counter() - start))
+    
+    start = time.perf_counter()
     sanityChecks()
+    startupProfile.append(('sanity checks (tools, directories)', time.perf_counter() - start))
+    
+    start = time.perf_counter()
+    if argv.daemon:
+        asyncio.run(runDaemon(argv.username, argv.password, argv.outputDirectory, argv.listen))
+    else:
+        asyncio.run(downloadVideo(argv.videoUrls, argv.username, argv.password, argv.outputDirectory))
+    startupProfile.append(('run (including the imports above)', time.perf_counter() - start))
     
-    asyncio.run(downloadVideo(argv.videoUrls, argv.username, argv.password, argv.outputDirectory))
+    if argv.profile:
+        printProfile()
     
     
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+PyDestreamerBench
+Local stand-in for the Microsoft Stream API and CDN, and throughput
+benchmarks of PyDestreamer running against it - no Stream tenant needed.
+
+Available under MIT license.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from termcolor import colored
+
+import PyDestreamer
+
+TS_NULL_PACKET = b'\x47\x1f\xff\x10' + b'\xff' * 184 # ignored by every MPEG-TS demuxer
+SEGMENT_DURATION = 2
+RENDITIONS = [('video_360', '640x360'), ('video_720', '1280x720'), ('audio', None)]
+
+
+class MockStreamServer:
+    """
+    Serves the video lists of channels and groups, video metadata JSON,
+    master and media playlists, AES-128 encrypted fragments and the
+    protection key in the layout downloadVideo expects. Audio tracks after the first one are declared as
+    EXT-X-MEDIA renditions. Every response can be delayed (latency), every connection is
+    limited to a bandwidth and a part of the fragment requests fails with 503.
+    Fragments are MPEG-TS, real audio/video (when ffmpeg is available)
+    padded with null packets to the requested size, encrypted on the fly.
+    """
+    def __init__(self, segments, segmentSize, latency=0, bandwidth=0, errorRate=0, realMedia=False, channelVideos=250, audioTracks=1):
+        self.segments = segments
+        self.renditions = RENDITIONS + [('audio_%d' % i, None) for i in range(2, audioTracks + 1)]
+        self.channelVideos = channelVideos
+        self.segmentSize = segmentSize
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.key = os.urandom(16)
+        self.base = None
+        self.stats = {'requests': 0, 'bytes': 0, 'errors': 0}
+        self.media = dict([(name, self.generateMedia(name, resolution) if realMedia else [b''] * segments) for name, resolution in self.renditions])
+
+    def generateMedia(self, name, resolution):
+        # real content made by ffmpeg, cut into segments at packet boundaries
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'media.ts')
+            if resolution is None:
+                source = ['-f', 'lavfi', '-i', 'sine=frequency=440', '-c:a', 'aac']
+            else:
+                source = ['-f', 'lavfi', '-i', 'testsrc=size=%s:rate=25' % resolution, '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '50']
+            subprocess.run(['ffmpeg', '-v', 'error', '-y'] + source + ['-t', str(self.segments * SEGMENT_DURATION), '-f', 'mpegts', path], check=True)
+            with open(path, 'rb') as file:
+                data = file.read()
+        packets = len(data) // 188
+        bounds = [packets * i // self.segments * 188 for i in range(self.segments + 1)]
+        return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+    def fragment(self, name, n):
+        data = self.media[name][n]
+        if len(data) < self.segmentSize:
+            data += TS_NULL_PACKET * ((self.segmentSize - len(data)) // 188)
+        data += bytes([16 - len(data) % 16]) * (16 - len(data) % 16) # PKCS7 padding
+        encryptor = Cipher(algorithms.AES(self.key), modes.CBC(n.to_bytes(16, 'big')), backend=default_backend()).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def metadata(self, videoID):
+        return json.dumps({
+            'name': 'Benchmark video %s' % videoID[:8],
+            'publishedDate': '2020-03-01T10:00:00.0000000Z',
+            'media': {'duration': 'PT%dS' % (self.segments * SEGMENT_DURATION)},
+            'playbackUrls': [{'mimeType': 'application/vnd.apple.mpegurl', 'playbackUrl': '%s/playback?playbackurl=%s/hls/%s/manifest.m3u8' % (self.base, self.base, videoID)}]
+        }).encode('utf-8')
+
+    def masterPlaylist(self):
+        bandwidth = self.segmentSize * 8 // SEGMENT_DURATION
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+        for name, resolution in self.renditions:
+            if name.startswith('audio_'):
+                lines += ['#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="%s",URI="%s/index.m3u8"' % (name, name)]
+            elif resolution is None:
+                lines += ['#EXT-X-STREAM-INF:BANDWIDTH=%d,CODECS="mp4a.40.2"' % bandwidth, name + '/index.m3u8']
+            else:
+                lines += ['#EXT-X-STREAM-INF:BANDWIDTH=%d,RESOLUTION=%s,CODECS="avc1.4d401e"' % (bandwidth, resolution), name + '/index.m3u8']
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def mediaPlaylist(self, videoID, name):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:%d' % SEGMENT_DURATION, '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-KEY:METHOD=AES-128,URI="%s/key/%s"' % (self.base, videoID)]
+        for n in range(self.segments):
+            lines += ['#EXTINF:%d.000,' % SEGMENT_DURATION, 'Fragments(%s=%d,format=m3u8-aapl)' % (name, n)]
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def channelPage(self, channelID, query):
+        # paged like the Stream API ($top, $skip), the video IDs are the same on every request
+        top, skip = int(query.get('$top', ['100'])[0]), int(query.get('$skip', ['0'])[0])
+        videos = [{'id': str(uuid.uuid5(uuid.NAMESPACE_URL, '%s/%d' % (channelID, i)))} for i in range(skip, min(skip + top, self.channelVideos))]
+        return json.dumps({'value': videos}).encode('utf-8')
+
+    def route(self, path, query):
+        match = re.match(r'^/api/(channels|groups)/([^/?]+)/videos$', path)
+        if match:
+            return 200, 'application/json', self.channelPage(match.group(2), query)
+        match = re.match(r'^/api/videos/([^/?]+)$', path)
+        if match:
+            return 200, 'application/json', self.metadata(match.group(1))
+        match = re.match(r'^/hls/([^/]+)/manifest\.m3u8$', path)
+        if match:
+            return 200, 'application/vnd.apple.mpegurl', self.masterPlaylist()
+        match = re.match(r'^/hls/([^/]+)/([^/]+)/index\.m3u8$', path)
+        if match and match.group(2) in self.media:
+            return 200, 'application/vnd.apple.mpegurl', self.mediaPlaylist(match.group(1), match.group(2))
+        match = re.match(r'^/hls/([^/]+)/([^/]+)/Fragments\(([^=]+)=(\d+)[^)]*\)$', path)
+        if match and match.group(3) in self.media and int(match.group(4)) < self.segments:
+            if random.random() < self.errorRate:
+                self.stats['errors'] += 1
+                return 503, 'text/plain', b'Injected error'
+            return 200, 'video/MP2T', self.fragment(match.group(3), int(match.group(4)))
+        if re.match(r'^/key/([^/]+)$', path):
+            return 200, 'application/octet-stream', self.key
+        return 404, 'text/plain', b'Not found'
+
+    async def handle(self, reader, writer):
+        try:
+            while True: # keep-alive, the native downloader reuses its connections
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                while (await reader.readline()).strip() != b'':
+                    pass # headers are not needed
+                if self.latency > 0:
+                    await asyncio.sleep(self.latency)
+                url = urllib.parse.urlparse(target)
+                status, contentType, body = self.route(urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query))
+                self.stats['requests'] += 1
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' % (status, 'OK' if status == 200 else 'Error', contentType, len(body))).encode('latin-1'))
+                chunk = 65536
+                for i in range(0, len(body), chunk):
+                    writer.write(body[i:i + chunk])
+                    await writer.drain()
+                    if self.bandwidth > 0:
+                        await asyncio.sleep(len(body[i:i + chunk]) / self.bandwidth)
+                self.stats['bytes'] += len(body)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=0, ready=None):
+        server = await asyncio.start_server(self.handle, host=host, port=port)
+        self.base = 'http://%s:%d' % (host, server.sockets[0].getsockname()[1])
+        if ready is not None:
+            ready(self.base)
+        async with server:
+            await server.serve_forever()
+
+
+def runServer(config, queue):
+    # runs in its own process, so serving does not steal CPU time from the measured client
+    server = MockStreamServer(**config)
+    asyncio.run(server.serve(ready=lambda base: queue.put((base, server.key))))
+
+
+def startServer(config):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=runServer, args=(config, queue), daemon=True)
+    process.start()
+    base, key = queue.get(timeout=600)
+    return process, base
+
+
+async def runScenario(base, scenario, options):
+    outputDirectory = tempfile.mkdtemp(prefix='pydestreamer-bench-')
+    args = ['-v', 'benchmark', '-o', outputDirectory, '-q', options.quality, '--cacheDirectory', '', '--apiBase', base,
+            '--downloader', scenario['downloader'], '-c', str(scenario['conn']), '--retries', str(options.retries),
+            '--downloadWorkers', str(options.downloadWorkers), '--mergeWorkers', str(options.mergeWorkers)]
+    if scenario['mode'] == 'stream':
+        args.append('--streamMerge')
+    elif scenario['mode'] == 'decrypt':
+        args += ['--decryptWorkers', str(os.cpu_count() or 1)]
+    elif scenario['mode'] == 'download':
+        args.append('--noMerge')
+    if options.metrics is not None:
+        args += ['--metrics', options.metrics]
+    PyDestreamer.argv = PyDestreamer.parseArguments(args)
+    PyDestreamer.metrics = PyDestreamer.Metrics()
+
+    cookie = 'Authorization=benchmark Signature=benchmark'
+    jobs = [PyDestreamer.VideoJob('https://web.microsoftstream.com/video/%s' % uuid.uuid4()) for i in range(scenario['batch'])]
+    start = time.time()
+    try:
+        resolved = await PyDestreamer.resolveMetadata(jobs, cookie)
+        metadataTime = time.time() - start
+        for job in resolved:
+            await PyDestreamer.chooseRendition(job, interactive=False)
+
+        pipeline = PyDestreamer.Pipeline(cookie, outputDirectory)
+        await pipeline.start()
+        for job in resolved:
+            pipeline.submit(job)
+        await pipeline.join()
+        total = time.time() - start
+    finally:
+        shutil.rmtree(outputDirectory, ignore_errors=True)
+
+    done = [job for job in jobs if job.status == 'done']
+    size = sum([sum([p['bytes'] for p in job.progress.values()]) for job in done])
+    result = dict(scenario)
+    result.update({
+        'done': len(done),
+        'failed': len(jobs) - len(done),
+        'metadata': metadataTime,
+        'total': total,
+        'MB': size / 1e6,
+        'MB/s': size / 1e6 / total,
+    })
+    for stage in ('resolve', 'download', 'stream', 'merge'):
+        times = [job.timings[stage] for job in done if stage in job.timings]
+        if len(times) > 0:
+            result[stage] = sum(times) / len(times) # average per video
+    return result
+
+
+def benchmarkPlaylist(segments, repeat=3):
+    # the playlist rewriter alone, on a synthetic media playlist of a very long recording
+    server = MockStreamServer(segments, 0)
+    server.base = 'https://cdn.example.com'
+    playlist = server.mediaPlaylist(str(uuid.uuid4()), 'video_720').decode('utf-8')
+    link = '%s/hls/%s/video_720/index.m3u8' % (server.base, uuid.uuid4())
+    tmpDir = tempfile.mkdtemp(prefix='pydestreamer-bench-')
+    try:
+        times = list()
+        for i in range(repeat):
+            start = time.time()
+            rendition = PyDestreamer.writePlaylists(tmpDir, 'video', link, playlist, os.path.join(tmpDir, 'protectionKey'))
+            times.append(time.time() - start)
+        tracemalloc.start() # slows everything down, so memory is measured in a separate run
+        PyDestreamer.writePlaylists(tmpDir, 'video', link, playlist, os.path.join(tmpDir, 'protectionKey'))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(rendition['segments']) == segments and len(rendition['ivs']) == segments
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    return {'mode': 'playlist', 'segments': segments, 'playlistMB': len(playlist) / 1e6, 'seconds': min(times), 'segments/s': segments / max(1e-6, min(times)), 'peakMB': peak / 1e6}
+
+
+def printResult(result):
+    stages = ' '.join(['%s %.2fs' % (stage, result[stage]) for stage in ('metadata', 'resolve', 'download', 'stream', 'merge') if stage in result])
+    print(colored('%-8s %-7s segments %-5d conn %-3d batch %-3d | %d ok %d failed | %s | total %.2fs, %.1f MB, %.2f MB/s', 'green' if result['failed'] == 0 else 'red') % (
+        result['mode'], result['downloader'], result['segments'], result['conn'], result['batch'], result['done'], result['failed'], stages, result['total'], result['MB'], result['MB/s']))
+
+
+def commaList(cast):
+    return lambda text: [cast(item) for item in text.split(',') if item.strip() != '']
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='PyDestreamerBench', description='Throughput benchmarks of PyDestreamer against a local mock of Microsoft Stream.\nEvery combination of the comma separated lists is measured.', epilog='examples:\n\tpython %(prog)s.py --segments 50,200 --conn 4,16 --batch 1,4\n\tpython %(prog)s.py --mode files,decrypt,stream --latency 0.05 --bandwidth 5\n\tpython %(prog)s.py --serve --port 8000\n\tpython %(prog)s.py --quality all --audioTracks 2\n\tpython %(prog)s.py --playlist 1000,50000\n', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--segments', type=commaList(int), required=False, default=[50], help='Fragments per rendition')
+    parser.add_argument('--segmentSize', type=float, required=False, default=1.0, help='Size of one fragment in MB')
+    parser.add_argument('--conn', type=commaList(int), required=False, default=[16], help='Values of PyDestreamer --conn')
+    parser.add_argument('--batch', type=commaList(int), required=False, default=[1], help='Number of videos downloaded in one run')
+    parser.add_argument('--downloader', type=commaList(str), required=False, default=['native'], help='aria2c and/or native')
+    parser.add_argument('--mode', type=commaList(str), required=False, default=['download'], help='download (no merge), files (ffmpeg decrypts), decrypt (--decryptWorkers), stream (--streamMerge)')
+    parser.add_argument('--downloadWorkers', type=int, required=False, default=1, help='Value of PyDestreamer --downloadWorkers')
+    parser.add_argument('--mergeWorkers', type=int, required=False, default=1, help='Value of PyDestreamer --mergeWorkers')
+    parser.add_argument('--quality', type=str, required=False, default='0', help='Value of PyDestreamer -q, e.g. 0,1 or all')
+    parser.add_argument('--audioTracks', type=int, required=False, default=1, help='Mock server: number of audio tracks of every video')
+    parser.add_argument('--retries', type=int, required=False, default=5, help='Value of PyDestreamer --retries')
+    parser.add_argument('--latency', type=float, required=False, default=0, help='Mock server: delay of every response in seconds')
+    parser.add_argument('--bandwidth', type=float, required=False, default=0, help='Mock server: bandwidth of every connection in MB/s (0 = unlimited)')
+    parser.add_argument('--errorRate', type=float, required=False, default=0, help='Mock server: fraction of fragment requests failing with 503')
+    parser.add_argument('--json', type=str, required=False, help='Append results to this file as JSON lines')
+    parser.add_argument('--metrics', type=str, required=False, help='Append the per-stage metrics of PyDestreamer (--metrics) to this file')
+    parser.add_argument('--playlist', type=commaList(int), required=False, help='Only measure the playlist rewriter on synthetic playlists with these numbers of segments, e.g. 50000')
+    parser.add_argument('--serve', required=False, default=False, action="store_true", help="Only run the mock server (use with PyDestreamer --apiBase)")
+    parser.add_argument('--port', type=int, required=False, default=8000, help='Port of the mock server with --serve')
+    options = parser.parse_args()
+
+    if options.playlist is not None:
+        for segments in options.playlist:
+            result = benchmarkPlaylist(segments)
+            print(colored('playlist segments %-7d (%.1f MB) | %.3fs, %.0f segments/s, peak memory %.1f MB', 'green') % (segments, result['playlistMB'], result['seconds'], result['segments/s'], result['peakMB']))
+            if options.json is not None:
+                with open(options.json, 'a') as file:
+                    file.write(json.dumps(result) + '\n')
+        return
+
+    realMedia = any([mode != 'download' for mode in options.mode])
+    if realMedia and shutil.which('ffmpeg') is None:
+        print(colored('Merging modes need ffmpeg in $PATH, use --mode download without it.', 'red'))
+        exit(1)
+    if 'stream' in options.mode and 'aria2c' in options.downloader:
+        print(colored('The stream mode (--streamMerge) works only with the native downloader, measure aria2c in another run.', 'red'))
+        exit(1)
+    if 'aria2c' in options.downloader and shutil.which('aria2c') is None:
+        print(colored('The aria2c downloader needs aria2c in $PATH.', 'red'))
+        exit(1)
+
+    if options.serve:
+        server = MockStreamServer(options.segments[0], int(options.segmentSize * 1e6), options.latency, options.bandwidth * 1e6, options.errorRate, realMedia, audioTracks=options.audioTracks)
+        asyncio.run(server.serve(port=options.port, ready=lambda base: print(colored('Mock Stream server listening on %s' % base, 'green'))))
+        return
+
+    results = list()
+    for segments in options.segments:
+        config = {'segments': segments, 'segmentSize': int(options.segmentSize * 1e6), 'latency': options.latency, 'bandwidth': options.bandwidth * 1e6, 'errorRate': options.errorRate, 'realMedia': realMedia, 'audioTracks': options.audioTracks}
+        process, base = startServer(config)
+        try:
+            for mode, downloader, conn, batch in itertools.product(options.mode, options.downloader, options.conn, options.batch):
+                scenario = {'mode': mode, 'downloader': downloader, 'segments': segments, 'conn': conn, 'batch': batch}
+                print(colored('\nRunning: %s' % json.dumps(scenario), 'yellow'))
+                result = asyncio.run(runScenario(base, scenario, options))
+                results.append(result)
+                if options.json is not None:
+                    with open(options.json, 'a') as file:
+                        file.write(json.dumps(result) + '\n')
+        finally:
+            process.terminate()
+
+    print(colored('\nResults:', 'green'))
+    for result in results:
+        printResult(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+PyDestreamer tests
+Resuming an interrupted download from the fragment journal, parsing of the
+media playlists.
+
+Run with: python -m unittest test_PyDestreamer
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import PyDestreamer
+
+
+class FakeDownloader:
+    # stands in for NativeDownloader, writes every requested fragment in full
+    def __init__(self, content):
+        self.content = content
+        self.requested = list()
+
+    async def download(self, job, name, segments, n, journal):
+        for url, path in segments:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(self.content[url])
+            self.requested.append(url)
+            journal.done(path, len(self.content[url]))
+        return 0
+
+
+class SegmentJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        PyDestreamer.argv = PyDestreamer.parseArguments(['-v', 'https://web.microsoftstream.com/video/00000000-0000-0000-0000-000000000000', '-o', self.directory, '-d', 'native'])
+        PyDestreamer.metrics = PyDestreamer.Metrics()
+        self.job = PyDestreamer.VideoJob(PyDestreamer.argv.videoUrls[0])
+        segmentsDir = os.path.join(self.job.tmpDir, 'video_segments')
+        os.makedirs(segmentsDir)
+        self.segments = [('https://cdn/fragment%d' % n, os.path.join(segmentsDir, 'fragment%d' % n)) for n in range(3)]
+        self.content = {url: bytes([n]) * 1000 for n, (url, path) in enumerate(self.segments)}
+        self.job.renditions['video'] = {'segments': self.segments}
+        self.aria2cLog = os.path.join(self.job.tmpDir, 'video_aria2c.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def download(self):
+        journal = PyDestreamer.SegmentJournal(self.job.tmpDir)
+        for url, path in self.segments:
+            with open(path, 'wb') as file:
+                file.write(self.content[url])
+            journal.done(path, len(self.content[url]))
+        journal.save()
+
+    def testTruncatedFragmentIsFetchedAgain(self):
+        self.download()
+        url, path = self.segments[1]
+        with open(path, 'r+b') as file:
+            file.truncate(400)
+
+        downloader = FakeDownloader(self.content)
+        asyncio.run(PyDestreamer.downloadJob(self.job, 'cookie', downloader, PyDestreamer.BandwidthController(), PyDestreamer.ConnectionBudget(4), PyDestreamer.FragmentCache('', 0)))
+
+        self.assertEqual(downloader.requested, [url])
+        self.assertEqual(os.path.getsize(path), 1000)
+        journal = PyDestreamer.SegmentJournal(self.job.tmpDir)
+        self.assertEqual(journal.segments[journal.key(path)], {'status': 'done', 'size': 1000})
+        self.assertEqual(journal.missing(self.segments), [])
+
+    def testScanDropsFragmentWhichNoLongerMatches(self):
+        self.download()
+        url, path = self.segments[0]
+        with open(path, 'r+b') as file:
+            file.truncate(400)
+        journal = PyDestreamer.SegmentJournal(self.job.tmpDir)
+        journal.scan(self.segments, self.aria2cLog)
+        self.assertEqual(journal.missing(self.segments), [self.segments[0]])
+        self.assertFalse(os.path.exists(path))
+
+    def testScanAdoptsOnlyWhatAria2cCompleted(self):
+        # the second fragment was being written when aria2c stopped, before its .aria2 control file existed
+        for url, path in self.segments[:2]:
+            with open(path, 'wb') as file:
+                file.write(self.content[url])
+        with open(self.aria2cLog, 'w') as file:
+            file.write('2021-05-20 10:00:00.000000 [NOTICE] [RequestGroup.cc:1216] Download complete: %s\n' % self.segments[0][1])
+        journal = PyDestreamer.SegmentJournal(self.job.tmpDir)
+        journal.scan(self.segments, self.aria2cLog)
+        self.assertEqual(journal.missing(self.segments), self.segments[1:])
+        self.assertFalse(os.path.exists(self.aria2cLog))
+
+
+class WritePlaylistsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testEveryKeyIsRecorded(self):
+        playlist = '\n'.join(['#EXTM3U', '#EXT-X-MEDIA-SEQUENCE:0',
+            '#EXT-X-KEY:METHOD=AES-128,URI="key1"', '#EXTINF:4.0,', 'Fragments(0)', '#EXTINF:4.0,', 'Fragments(1)',
+            '#EXT-X-KEY:METHOD=AES-128,URI="key2"', '#EXTINF:4.0,', 'Fragments(2)',
+            '#EXT-X-KEY:METHOD=AES-128,URI="key1"', '#EXTINF:4.0,', 'Fragments(3)', '#EXT-X-ENDLIST'])
+        rendition = PyDestreamer.writePlaylists(self.directory, 'video', 'https://cdn/hls/video/index.m3u8', playlist, '/tmp/protectionKey')
+        self.assertEqual(rendition['keyUris'], ['https://cdn/hls/video/key1', 'https://cdn/hls/video/key2'])
+        self.assertEqual(rendition['keys'], [0, 0, 1, 0])
+        self.assertEqual(len(rendition['ivs']), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()